@@ -1,2 +1,2 @@
 VERSION = (0,3,1,'svn')
-from fullhistory import register_model, get_active_histories, FullHistoryHandler
+from fullhistory import register_model, get_active_histories, FullHistoryHandler, buffer_histories, rotate_request, history_session
@@ -27,6 +27,9 @@ class FullHistoryAdminSite(admin.AdminSite):
                 url(r'^%s/%s/(?P<object_id>.+)/history/version/(?P<version>\d+)/$' % (model._meta.app_label, model._meta.module_name), 
                     wrap(self.history_version_view, model),
                     name='%sadmin_%s_%s_history_version' % info),
+                url(r'^%s/%s/(?P<object_id>.+)/history/compare/$' % (model._meta.app_label, model._meta.module_name), 
+                    wrap(self.history_compare_view, model),
+                    name='%sadmin_%s_%s_history_compare' % info),
             )
         return urls
 
@@ -64,6 +67,17 @@ class FullHistoryAdminSite(admin.AdminSite):
                                      {
                                       'admin_name': getattr(self, 'name', 'admin'),})
 
+    def history_compare_view(self, request, object_id, model):
+        opts = model._meta
+        return views.history_compare(request, 
+                                     object_id, 
+                                     model,
+                                     ("admin/%s/%s/object_compare_fullhistory.html" % (opts.app_label, opts.object_name.lower()),
+                                      "admin/%s/object_compare_fullhistory.html" % opts.app_label,
+                                      "admin/object_compare_fullhistory.html"),
+                                     {
+                                      'admin_name': getattr(self, 'name', 'admin'),})
+
 class FullHistoryAdmin(admin.ModelAdmin):
     def __call__(self, request, url): #django 1.0
         if url:
@@ -105,6 +119,9 @@ class FullHistoryAdmin(admin.ModelAdmin):
             url(r'^(?P<object_id>.+)/history/version/(?P<version>\d+)/$', 
                 wrap(self.history_version_view),
                 name='%sadmin_%s_%s_history_version' % info),
+            url(r'^(?P<object_id>.+)/history/compare/$', 
+                wrap(self.history_compare_view),
+                name='%sadmin_%s_%s_history_compare' % info),
         )
         return my_urls + urls
     
@@ -137,6 +154,15 @@ class FullHistoryAdmin(admin.ModelAdmin):
                                       "admin/%s/object_version_fullhistory.html" % opts.app_label,
                                       "admin/object_version_fullhistory.html"), self.get_context())
 
+    def history_compare_view(self, request, object_id):
+        opts = self.model._meta
+        return views.history_compare(request, 
+                                     object_id, 
+                                     self.model, 
+                                     ("admin/%s/%s/object_compare_fullhistory.html" % (opts.app_label, opts.object_name.lower()),
+                                      "admin/%s/object_compare_fullhistory.html" % opts.app_label,
+                                      "admin/object_compare_fullhistory.html"), self.get_context())
+
     def log_addition(self, request, obj):
         fullhistory.adjust_history(obj, 'A')
 
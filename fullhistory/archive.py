@@ -0,0 +1,98 @@
+import gzip
+import json
+import sys
+
+def open_archive(path, mode='rb'):
+    '''
+    Opens a history archive, '-' is stdin or stdout
+    Archives are gzip compressed unless a plain file is read
+    '''
+    if path == '-':
+        if 'w' in mode:
+            return gzip.GzipFile(fileobj=sys.stdout, mode=mode)
+        return gzip.GzipFile(fileobj=sys.stdin, mode=mode)
+    if 'w' in mode or path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def read_archive(stream):
+    '''
+    Yields the decoded lines of an archive
+    '''
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+class RecentSet(object):
+    '''
+    Remembers the most recently used keys
+    The least recently used quarter is forgotten once there are more than max_size
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.keys = dict()
+        self.tick = 0
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def add(self, key):
+        self.tick += 1
+        self.keys[key] = self.tick
+        if len(self.keys) > self.max_size:
+            for key, tick in sorted(self.keys.items(), key=lambda item: item[1])[:len(self.keys) // 4 + 1]:
+                del self.keys[key]
+
+class ArchiveWriter(object):
+    '''
+    Writes histories as JSON lines, each Request before the first history that refers to it
+    Only the last max_requests requests are remembered, a request that is forgotten is
+    written again and the importer maps it to the row it already created
+    '''
+    def __init__(self, stream, max_requests=100000):
+        self.stream = stream
+        self.content_types = dict()
+        self.seen_requests = RecentSet(max_requests)
+        self.count = 0
+        self.request_count = 0
+
+    def write_histories(self, histories):
+        from django.contrib.contenttypes.models import ContentType
+        from models import Request
+        new_requests = set([history.request_id for history in histories
+                            if history.request_id is not None and 
+                               history.request_id not in self.seen_requests])
+        requests = Request.objects.in_bulk(list(new_requests))
+        for history in histories:
+            if history.request_id in new_requests:
+                rq = requests[history.request_id]
+                self.write({'type': 'request',
+                            'id': rq.pk,
+                            'user_name': rq.user_name,
+                            'user_pk': rq.user_pk,
+                            'request_path': rq.request_path})
+                new_requests.discard(rq.pk)
+                self.request_count += 1
+            if history.request_id is not None:
+                self.seen_requests.add(history.request_id)
+            if history.content_type_id not in self.content_types:
+                ct = ContentType.objects.get_for_id(history.content_type_id)
+                self.content_types[history.content_type_id] = '%s.%s' % (ct.app_label, ct.model)
+            self.write({'type': 'history',
+                        'content_type': self.content_types[history.content_type_id],
+                        'object_id': history.object_id,
+                        'revision': history.revision,
+                        'action_time': str(history.action_time),
+                        'data': history._data,
+                        'request': history.request_id,
+                        'site': history.site_id,
+                        'action': history.action,
+                        'info': history.info})
+            self.count += 1
+
+    def write(self, row):
+        self.stream.write(json.dumps(row))
+        self.stream.write('\n')
+
+    def close(self):
+        self.stream.close()
@@ -0,0 +1,152 @@
+'''
+Optional cache of reconstructed versions keyed by (content_type_id, object_id, revision)
+Enabled with FULLHISTORY_VERSION_CACHE set to 'local' or 'django'
+'''
+import threading
+
+from django.conf import settings
+from django.utils.hashcompat import md5_constructor
+
+import encoders
+from signals import post_create, post_adjust
+
+class LocalVersionCache(object):
+    '''
+    An in process LRU of encoded versions
+    The least recently used entries are evicted once their total size exceeds max_bytes
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = dict()
+        self.size = 0
+        self.tick = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.tick += 1
+            entry[0] = self.tick
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def set(self, key, text):
+        if len(text) > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            self.remove(key)
+            self.tick += 1
+            self.entries[key] = [self.tick, text]
+            self.size += len(text)
+            if self.size > self.max_bytes:
+                self.evict()
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self.remove(key)
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def evict(self):
+        #free a quarter of the cache at once so sorting is not paid on every set
+        target = self.max_bytes * 3 / 4
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1][0]):
+            if self.size <= target:
+                break
+            self.remove(key)
+
+class DjangoVersionCache(object):
+    '''
+    Stores encoded versions in the cache backend configured by CACHE_BACKEND
+    '''
+    def __init__(self, timeout=None):
+        from django.core.cache import cache
+        self.cache = cache
+        self.timeout = timeout
+
+    def make_key(self, key):
+        content_type_id, object_id, revision = key
+        return 'fullhistory:version:%s:%s:%s' % (content_type_id,
+                                                 md5_constructor(object_id.encode('utf-8')).hexdigest(),
+                                                 revision)
+
+    def get(self, key):
+        return self.cache.get(self.make_key(key))
+
+    def set(self, key, text):
+        self.cache.set(self.make_key(key), text, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.make_key(key))
+
+CACHES = dict()
+CACHES_LOCK = threading.Lock()
+
+def get_version_cache():
+    '''
+    Returns the cache selected by FULLHISTORY_VERSION_CACHE, or None if it is disabled
+    '''
+    name = getattr(settings, 'FULLHISTORY_VERSION_CACHE', None)
+    if name is None:
+        return None
+    if name in CACHES:
+        return CACHES[name]
+    CACHES_LOCK.acquire()
+    try:
+        if name not in CACHES:
+            if name == 'local':
+                CACHES[name] = LocalVersionCache(getattr(settings, 'FULLHISTORY_VERSION_CACHE_BYTES',
+                                                         10 * 1024 * 1024))
+            elif name == 'django':
+                CACHES[name] = DjangoVersionCache(getattr(settings, 'FULLHISTORY_VERSION_CACHE_TIMEOUT',
+                                                          None))
+            else:
+                raise ValueError('Unknown version cache %s, use local or django' % name)
+        return CACHES[name]
+    finally:
+        CACHES_LOCK.release()
+
+def make_key(content_type, object_id, revision):
+    return (getattr(content_type, 'pk', content_type), unicode(object_id), int(revision))
+
+def get_version(content_type, object_id, revision):
+    '''
+    Returns the cached state of an object at revision, or None
+    '''
+    cache = get_version_cache()
+    if cache is None:
+        return None
+    text = cache.get(make_key(content_type, object_id, revision))
+    if text is None:
+        return None
+    return encoders.decode(text)
+
+def set_version(content_type, object_id, revision, value):
+    cache = get_version_cache()
+    if cache is not None:
+        cache.set(make_key(content_type, object_id, revision), encoders.encode(value, 'compact'))
+
+def invalidate_version(sender, fullhistory, **kwargs):
+    '''
+    Drops the cached version of a revision that was written or adjusted
+    Earlier revisions do not change and later ones are never cached before they exist
+    '''
+    cache = get_version_cache()
+    if cache is not None and fullhistory.revision is not None:
+        cache.delete(make_key(fullhistory.content_type_id, fullhistory.object_id, fullhistory.revision))
+
+post_create.connect(invalidate_version)
+post_adjust.connect(invalidate_version)
@@ -0,0 +1,96 @@
+'''
+Codecs for the data column of FullHistory and HistoryCheckpoint
+
+Encoded text starts with the prefix of the codec that wrote it, plain JSON
+carries no prefix so rows written before codecs existed still decode.
+'''
+import base64
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+class JSONCodec(object):
+    '''
+    Plain JSON as written by DjangoJSONEncoder
+    '''
+    prefix = ''
+
+    def __init__(self, **options):
+        self.encoder = DjangoJSONEncoder(**options)
+
+    def encode(self, value):
+        return self.encoder.encode(value)
+
+    def decode(self, text):
+        return json.loads(text)
+
+class ZlibCodec(JSONCodec):
+    '''
+    Compact JSON compressed with zlib and stored as base64
+    '''
+    prefix = 'zjson1:'
+
+    def __init__(self, level=6):
+        super(ZlibCodec, self).__init__(separators=(',', ':'))
+        self.level = level
+
+    def encode(self, value):
+        data = zlib.compress(self.encoder.encode(value), self.level)
+        return self.prefix + base64.b64encode(data)
+
+    def decode(self, text):
+        return json.loads(zlib.decompress(base64.b64decode(text[len(self.prefix):])))
+
+CODECS = {
+    'json': JSONCodec(),
+    'compact': JSONCodec(separators=(',', ':')),
+    'zlib': ZlibCodec(),
+}
+
+def register_codec(name, codec):
+    '''
+    Makes a codec available by name, its prefix must not be shared with another codec
+    or be a valid start of JSON text
+    '''
+    CODECS[name] = codec
+
+def get_codec(name=None):
+    '''
+    Returns the named codec or the one selected by FULLHISTORY_CODEC
+    '''
+    if name is None:
+        from django.conf import settings
+        name = getattr(settings, 'FULLHISTORY_CODEC', 'json')
+    return CODECS[name]
+
+def encode(value, name=None):
+    return get_codec(name).encode(value)
+
+def decode(text):
+    '''
+    Decodes text written by any registered codec
+    '''
+    for codec in CODECS.values():
+        if codec.prefix and text.startswith(codec.prefix):
+            return codec.decode(text)
+    return json.loads(text)
+
+def decode_many(texts):
+    '''
+    Decodes a list of texts, plain JSON texts are parsed together in one pass
+    '''
+    values = [None] * len(texts)
+    plain = list()
+    for index, text in enumerate(texts):
+        for codec in CODECS.values():
+            if codec.prefix and text.startswith(codec.prefix):
+                values[index] = codec.decode(text)
+                break
+        else:
+            plain.append(index)
+    if plain:
+        decoded = json.loads(u'[%s]' % u','.join([texts[index] for index in plain]))
+        for index, value in zip(plain, decoded):
+            values[index] = value
+    return values
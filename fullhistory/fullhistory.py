@@ -1,38 +1,127 @@
+from __future__ import with_statement
 try:
-    import thread
+    from threading import local
 except ImportError:
-    import dummy_thread as thread
+    from django.utils._threading_local import local
+from contextlib import contextmanager
+import atexit
+import time
+import weakref
 
+from django.conf import settings
+from django.db import transaction
 from django.db.models import signals
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.contenttypes.models import ContentType
 
-from models import FullHistory, Request
+from models import FullHistory, HistoryCheckpoint, Request
 from signals import post_create, post_adjust
-from serializers import Serializer, Deserializer
+from serializers import FieldExtractor, get_extractor, is_hashed, Deserializer
+import writer
+import stats
 
-# The state is a dictionary of lists. The key to the dict is the current
-# thread and the list is handled as a stack of values.
-STATE = {}
+# The state holds a stack of sessions per thread (or greenlet when threading
+# is monkey patched). Each session records the web request, its Request row
+# and any histories buffered for a single bulk write. Being thread local the
+# sessions are released with their thread and never seen by another one.
+class SessionState(local):
+    def __init__(self):
+        self.stack = list()
 
-def get_active_histories():
+STATE = SessionState()
+
+class HistorySession(object):
+    def __init__(self, request=None):
+        self.request = request
+        self.rq = None
+        self.rq_started = None
+        self.rq_changes = 0
+        self.pending = None
+        #started by get_session, not ended by a request or history_session
+        self.implicit = False
+
+    def rotation_due(self):
+        '''
+        Returns True if the Request of a session outside of a web request
+        is older or has recorded more changes than the configured limits
+        '''
+        if self.rq is None or self.request is not None:
+            return False
+        max_age = getattr(settings, 'FULLHISTORY_REQUEST_MAX_AGE', None)
+        max_changes = getattr(settings, 'FULLHISTORY_REQUEST_MAX_CHANGES', None)
+        if max_age and time.time() - self.rq_started >= max_age:
+            return True
+        return bool(max_changes and self.rq_changes >= max_changes)
+
+def current_session():
+    '''
+    Returns the innermost session of this thread or None
+    '''
+    if STATE.stack:
+        return STATE.stack[-1]
+    return None
+
+def get_session():
+    session = current_session()
+    if session is None:
+        session = HistorySession()
+        session.implicit = True
+        STATE.stack.append(session)
+    return session
+
+@contextmanager
+def history_session(request=None):
+    '''
+    Records the changes made inside the with block in a session of their own
+    Buffered histories are written when the block exits, if it raises they are dropped
+    when the transaction is rolled back (see rolling_back)
+    '''
+    session = HistorySession(request)
+    STATE.stack.append(session)
+    try:
+        try:
+            yield session
+        except:
+            if rolling_back():
+                session.pending = None
+            else:
+                flush_session(session, defer=True)
+            raise
+        flush_session(session, defer=True)
+    finally:
+        if session in STATE.stack:
+            STATE.stack.remove(session)
+
+def get_active_histories(flush=True):
     '''
     Returns histories that have been created during the current request
+    Buffered histories are written first unless flush is False
     '''
-    request, rq = STATE.get(thread.get_ident(), (None, None))
-    if rq is None:
+    session = current_session()
+    if session is None or session.rq is None:
         return FullHistory.objects.none()
-    return FullHistory.objects.filter(request=rq)
+    if flush and session.pending is not None:
+        flush_buffer()
+        #keep buffering the rest of the request
+        session.pending = list()
+    if writer.WRITER is not None:
+        writer.WRITER.flush()
+    if session.rq.pk is None:
+        return FullHistory.objects.none()
+    return FullHistory.objects.filter(request=session.rq)
 
 def get_or_create_request():
     '''
     Returns a request instance that is global for this request
     If this function is called outside of a web request then the user_name is marked as system
+    The request is saved together with the first history that uses it
     '''
-    thread_ident = thread.get_ident()
-    request, rq = STATE.get(thread_ident, (None, None))
-    if not rq:
+    session = get_session()
+    if session.rotation_due():
+        session.rq = None
+    if not session.rq:
         rq = Request()
+        request = session.request
         if request:
             rq.request_path = request.path
             if request.user.is_anonymous():
@@ -42,82 +131,324 @@ def get_or_create_request():
                 rq.user_name = unicode(request.user)[:255]
         else:
             rq.user_name = u'(System)'
-        rq.save()
-        STATE[thread_ident] = (request, rq)
-    return rq
+        session.rq = rq
+        session.rq_started = time.time()
+        session.rq_changes = 0
+    return session.rq
+
+def rotate_request():
+    '''
+    Starts a new Request for the changes recorded from now on in this thread
+    Long running jobs can call this to split their changes into several changesets
+    '''
+    get_session().rq = None
+
+def start_buffer():
+    '''
+    Collects histories created from now on in memory until flush_buffer is called
+    '''
+    session = get_session()
+    if session.pending is None:
+        session.pending = list()
+        OPEN_SESSIONS[session] = True
+
+#sessions that started buffering, the ones still buffering at exit are written then
+OPEN_SESSIONS = weakref.WeakKeyDictionary()
+
+def flush_open_sessions():
+    '''
+    Writes what is still buffered in the sessions of every thread, run at exit
+    '''
+    for session in list(OPEN_SESSIONS.keys()):
+        pending, session.pending = session.pending, None
+        if pending:
+            write_histories(pending)
+
+atexit.register(flush_open_sessions)
+
+def background_writes():
+    return getattr(settings, 'FULLHISTORY_WRITER', 'sync') == 'background'
+
+def flush_buffer(defer=False):
+    '''
+    Writes all buffered histories with a single bulk insert and stops buffering
+    With defer the histories are handed to the background writer when it is enabled
+    '''
+    flush_session(current_session(), defer)
+
+def flush_session(session, defer=False):
+    if session is None or session.pending is None:
+        return
+    pending, session.pending = session.pending, None
+    if defer and background_writes():
+        writer.get_writer(write_histories).put(pending)
+    else:
+        write_histories(pending)
+
+def rolling_back():
+    '''
+    Returns True if the changes made so far are in a managed transaction that was not
+    committed yet, which the caller rolls back when it sees an exception
+    Autocommitted changes are already stored, so their histories are kept
+    '''
+    return transaction.is_managed() and transaction.is_dirty()
+
+def discard_buffer():
+    '''
+    Drops buffered histories, used when the changes they describe were rolled back
+    '''
+    session = current_session()
+    if session is not None:
+        session.pending = None
+
+@contextmanager
+def buffered():
+    '''
+    Buffers the histories created inside the with block and writes them when it exits
+    Does nothing if the current session is already buffering
+    '''
+    session = get_session()
+    if session.pending is not None:
+        yield session
+        return
+    start_buffer()
+    try:
+        yield session
+    except:
+        if rolling_back():
+            discard_buffer()
+        else:
+            flush_buffer(defer=True)
+        raise
+    flush_buffer(defer=True)
+
+def buffer_histories(func):
+    '''
+    Decorator that buffers the histories created by func and writes them when it returns
+    If func raises inside a transaction that is rolled back the histories are discarded,
+    apply it below transaction.commit_on_success
+    '''
+    def _buffer_histories(*args, **kwargs):
+        with buffered():
+            return func(*args, **kwargs)
+    return _buffer_histories
+
+def write_histories(pending):
+    '''
+    Saves a list of (history, instance) pairs and sends post_create for each
+    '''
+    if not pending:
+        return
+    heads = FullHistory.objects.bulk_save([fh for fh, entry in pending])
+    for head in heads:
+        if head.checkpoint_due():
+            history = [fh for fh, entry in pending 
+                       if fh.content_type_id == head.content_type_id and 
+                          fh.object_id == head.object_id][-1]
+            HistoryCheckpoint.objects.record(history)
+    for fh, entry in pending:
+        post_create.send(sender=type(entry), fullhistory=fh, instance=entry)
+
+def new_history(entry, **kwargs):
+    '''
+    Returns an unsaved FullHistory for entry without touching the database
+    The content type comes from the per process ContentType cache, which is
+    emptied by ContentType.objects.clear_cache(), and the site is SITE_ID as it
+    is set when the history is made, so sites that switch SITE_ID are recorded correctly
+    Each history of the session's request counts towards FULLHISTORY_REQUEST_MAX_CHANGES
+    '''
+    session = current_session()
+    if session is not None and session.rq is not None and kwargs.get('request') is session.rq:
+        session.rq_changes += 1
+    return FullHistory(content_type_id=ContentType.objects.get_for_model(entry).pk,
+                       object_id=entry.pk,
+                       site_id=settings.SITE_ID,
+                       **kwargs)
 
 class FullHistoryHandler(object):
     '''
     This class is responsible for handling and generating change logs for the model it is bound to
+    ``fields``, ``exclude`` and ``large_field_policy`` select what is recorded, see FieldExtractor
     '''
-    def __init__(self, model):
+    def __init__(self, model, track_changes=None, fields=None, exclude=None, large_field_policy=None):
         self.model = model
+        if fields is None and exclude is None and large_field_policy is None:
+            self.extractor = get_extractor(model)
+        else:
+            self.extractor = FieldExtractor(model, fields=fields, exclude=exclude, 
+                                            large_field_policy=large_field_policy)
+        self.lazy_initial = getattr(settings, 'FULLHISTORY_LAZY_INIT', False)
+        if track_changes is None:
+            track_changes = getattr(settings, 'FULLHISTORY_TRACK_CHANGES', False)
+        self.track_changes = track_changes
+        if stats.enabled():
+            stats.install(self)
 
-    def prepare_initial(self, entry):
+    def prepare_initial(self, entry, changes=None, state=None):
         '''
         Records the state of an object
+        ``state`` is the full data of the object if it was just extracted
+        When tracking changes, ``changes`` is the history data that was just
+        recorded and only those values of the snapshot are refreshed
         '''
-        entry._fullhistory = self.get_all_data(entry)
+        entry.__dict__.pop('_fullhistory_raw', None)
+        if state is not None:
+            entry._fullhistory = state
+        elif changes is not None and self.track_changes and '_fullhistory' in entry.__dict__:
+            for key, value in changes.items():
+                entry._fullhistory[key] = value[-1]
+        else:
+            entry._fullhistory = self.get_all_data(entry)
+        if self.track_changes:
+            self.capture_initial(entry)
 
-    def get_difference(self, entry):
+    def capture_initial(self, entry):
+        '''
+        Cheaply records the raw attribute values of an object
+        They are only serialized if the object is saved or adjusted
+        '''
+        entry._fullhistory_raw = entry.__dict__.copy()
+
+    def get_initial(self, entry):
+        '''
+        Returns the recorded state of an object
+        '''
+        if '_fullhistory' not in entry.__dict__ and '_fullhistory_raw' in entry.__dict__:
+            shadow = type(entry).__new__(type(entry))
+            shadow.__dict__.update(entry._fullhistory_raw)
+            self.prepare_initial(shadow)
+            entry._fullhistory = shadow._fullhistory
+            del entry._fullhistory_raw
+        return entry._fullhistory
+
+    def get_difference(self, entry, newdata=None):
         '''
         Given an object it returns a dictionary of tuples
         Each key of the dictionary is an attribute of the object
         Each tuple is the previous and current value
+        ``newdata`` is the current data of the object if it was already extracted
         '''
+        if self.track_changes and '_fullhistory_raw' in entry.__dict__:
+            return self.get_tracked_difference(entry)
         ret = dict()
-        newdata = self.get_all_data(entry)
-        keys = set(newdata.keys()) | set(entry._fullhistory.keys())
+        if newdata is None:
+            newdata = self.get_all_data(entry)
+        olddata = self.get_initial(entry)
+        keys = set(newdata.keys()) | set(olddata.keys())
         for key in keys:
-            oldvalue = entry._fullhistory.get(key, None)
+            oldvalue = olddata.get(key, None)
             newvalue = newdata.get(key, None)
             if oldvalue != newvalue:
                 ret[key] = (oldvalue, newvalue)
         return ret
 
+    def get_tracked_difference(self, entry):
+        '''
+        Same as get_difference but only serializes the fields whose values were
+        replaced since the last snapshot
+        '''
+        ret = dict()
+        extractor = self.extractor_for(entry)
+        raw = entry._fullhistory_raw
+        olddata = entry.__dict__.get('_fullhistory')
+        for name, attname, convert in extractor.changed_fields(entry, raw):
+            if olddata is None:
+                oldvalue = convert(raw.get(attname))
+            else:
+                oldvalue = olddata.get(name)
+            newvalue = convert(getattr(entry, attname))
+            if oldvalue != newvalue:
+                ret[name] = (oldvalue, newvalue)
+        if olddata is not None:
+            #many to many values are not attributes, compare them directly
+            for name in extractor.many_to_many:
+                oldvalue = olddata.get(name)
+                newvalue = extractor.get_related_pks(entry, name)
+                if oldvalue != newvalue:
+                    ret[name] = (oldvalue, newvalue)
+        return ret
+
     def get_all_data(self, entry):
         '''
         Returns a dictionary of all persistant values of an object
         '''
-        serializer = Serializer()
-        serial = serializer.serialize([entry])
-        serial = serial[0]
-        serial['fields'][entry._meta.pk.name] = serial['pk']
-        return serial['fields']
+        return self.extractor_for(entry).extract(entry)
 
-    def get_all_data_tuple(self, entry):
-        data = self.get_all_data(entry)
-        for key, value in data.items():
-            data[key] = (value,)
-        return data
+    def extractor_for(self, entry):
+        '''
+        Returns the extractor of entry, parents of the model use the one of their own handler
+        '''
+        if type(entry) is self.model:
+            return self.extractor
+        handler = REGISTERED_MODELS.get(type(entry))
+        if handler is not None:
+            return handler.extractor
+        return get_extractor(type(entry))
+
+    def get_all_data_tuple(self, entry, data=None):
+        if data is None:
+            data = self.get_all_data(entry)
+        return dict([(key, (value,)) for key, value in data.items()])
 
-    def get_object(self, data):
+    def get_object(self, data, instance=None):
+        '''
+        Builds an unsaved object from recorded data, hashed values are left out
+        Fields that were not recorded in full are copied from ``instance`` if given
+        '''
+        for key, value in data.items():
+            if is_hashed(value):
+                del data[key]
         info = {'pk': data.pop(self.model._meta.pk.name, None),
                 'model': "%s.%s" % (self.model._meta.app_label, self.model._meta.object_name.lower()),
                 'fields': data}
-        return list(Deserializer([info]))[0]
+        obj = list(Deserializer([info]))[0]
+        if instance is not None:
+            for field in self.model._meta.local_fields:
+                if field.name not in data and not field.primary_key:
+                    setattr(obj.object, field.attname, getattr(instance, field.attname))
+        return obj
 
     def create_history(self, entry, action):
         '''
         Returns a FullHistory object recording the change of the object provided
         '''
         request = get_or_create_request()
+        state = None
+        if action == 'C' or (action == 'U' and not 
+                             (self.track_changes and '_fullhistory_raw' in entry.__dict__)):
+            #extracted once, for the history and for the next snapshot
+            state = self.get_all_data(entry)
         if action == 'U':
-            data = self.get_difference(entry)
+            data = self.get_difference(entry, state)
             if len(data) == 0:
-                data = self.get_all_data_tuple(entry)
+                data = self.get_all_data_tuple(entry, state)
         elif action == 'C':
-            data = self.get_all_data_tuple(entry)
+            data = self.get_all_data_tuple(entry, state)
         else:
             data = None
-        fh = FullHistory(data=data, 
-                         content_object=entry, 
+        fh = new_history(entry,
+                         data=data, 
                          action=action, 
                          request=request)
-        fh.save()
+        session = get_session()
+        deferred = False
+        if session.pending is None and background_writes():
+            if session.implicit:
+                #nothing ends this session, hand the history to the writer right away
+                deferred = True
+            else:
+                start_buffer()
+        buffered = session.pending is not None
+        if buffered:
+            session.pending.append((fh, entry))
+        elif deferred:
+            writer.get_writer(write_histories).put([(fh, entry)])
+        else:
+            fh.save()
         self.apply_parents(entry, lambda x: self.create_history(x, action))
-        self.prepare_initial(entry)
-        post_create.send(sender=type(entry), fullhistory=fh, instance=entry)
+        self.prepare_initial(entry, data, state)
+        if not buffered and not deferred:
+            post_create.send(sender=type(entry), fullhistory=fh, instance=entry)
         return fh
 
     def adjust_history(self, obj, action='U'):
@@ -128,29 +459,48 @@ class FullHistoryHandler(object):
         delta = self.get_difference(obj)
         if delta:
             ct = ContentType.objects.get_for_model(obj)
-            try:
-                history = get_active_histories().filter(content_type=ct, 
-                                                        object_id=obj.pk).latest()
-            except FullHistory.DoesNotExist:
-                history = FullHistory(content_object=obj,
-                                      request=get_or_create_request(), 
-                                      action=action, 
-                                      data=dict())
+            history = self.get_pending_history(ct, obj.pk)
+            pending = history is not None
+            if not pending:
+                try:
+                    history = get_active_histories(flush=False).filter(content_type=ct, 
+                                                                        object_id=obj.pk).latest()
+                except FullHistory.DoesNotExist:
+                    history = new_history(obj,
+                                          request=get_or_create_request(), 
+                                          action=action, 
+                                          data=dict())
             if history.action == 'C':
                 for key, value in delta.items():
                     delta[key] = (value[1],)
+            size = len(history._data or '')
             data = history.data
             data.update(delta)
             history.data = data
+            #what the adjustment added to the stored row, for the stats
+            history._size_change = len(history._data) - size
             history.info = history.create_info()
-            history.save()
-            self.prepare_initial(obj)
+            if not pending:
+                history.save()
+            self.prepare_initial(obj, delta)
             post_adjust.send(sender=type(obj), 
                              fullhistory=history, 
                              instance=obj)
             return history
         return None
 
+    def get_pending_history(self, content_type, pk):
+        '''
+        Returns the latest buffered history of an object in the current session, if any
+        '''
+        session = current_session()
+        if session is None or not session.pending:
+            return None
+        for fh, entry in reversed(session.pending):
+            if fh.content_type_id == content_type.pk and unicode(fh.object_id) == unicode(pk):
+                return fh
+        return None
+
     def apply_parents(self, instance, func):
         '''
         Iterates through all non-abstract inherited parents and applies the supplied function
@@ -164,6 +514,9 @@ REGISTERED_MODELS = dict()
 def init_history_signal(instance, **kwargs):
     if instance.pk is not None:
         handler = REGISTERED_MODELS[type(instance)]
+        if handler.lazy_initial:
+            handler.capture_initial(instance)
+            return
         try:
             handler.prepare_initial(instance)
             handler.apply_parents(instance, handler.prepare_initial)
@@ -180,28 +533,64 @@ def delete_history_signal(instance, **kwargs):
     REGISTERED_MODELS[type(instance)].create_history(instance, 'D')
 
 def end_session():
-    STATE.pop(thread.get_ident(), None)
+    '''
+    Writes the buffered histories of the current session and closes it
+    '''
+    flush_buffer(defer=True)
+    if STATE.stack:
+        STATE.stack.pop()
 
 def adjust_history(instance, action='U'):
     return REGISTERED_MODELS[type(instance)].adjust_history(instance, action)
 
-def register_model(model, cls=None):
+def register_model(model, cls=None, **options):
+    '''
+    Records the history of a model, options are passed on to the handler class
+    The field options only apply to the model itself, its parents record all their fields
+    '''
     if model in REGISTERED_MODELS:
         return
+    parent_options = dict([(key, value) for key, value in options.items() 
+                           if key not in ('fields', 'exclude', 'large_field_policy')])
     for parent in model._meta.parents.keys():
-        register_model(parent, cls)
+        register_model(parent, cls, **parent_options)
     if cls is None:
         cls = FullHistoryHandler
     signals.post_init.connect(init_history_signal, sender=model)
     signals.post_save.connect(save_history_signal, sender=model)
     signals.post_delete.connect(delete_history_signal, sender=model)
-    REGISTERED_MODELS[model] = cls(model)
+    REGISTERED_MODELS[model] = cls(model, **options)
     
 class FullHistoryMiddleware(object):
+    '''
+    Attributes changes to the current user, with FULLHISTORY_BUFFER the histories
+    of a request are written in one batch when the response is returned
+    '''
     def process_request(self, request):
-        STATE[thread.get_ident()] = (request, None)
+        #a fresh stack so nothing left over from an earlier request on this thread is reused
+        STATE.stack = [HistorySession(request)]
+        if getattr(settings, 'FULLHISTORY_BUFFER', False):
+            start_buffer()
+        if stats.enabled():
+            stats.start_request()
+
+    def process_exception(self, request, exception):
+        #TransactionMiddleware rolls back after this, without it the changes are committed
+        if rolling_back():
+            discard_buffer()
 
     def process_response(self, request, response):
+        summary = stats.LOCAL.summary
+        if summary is None:
+            end_session()
+            return response
+        start = time.time()
         end_session()
+        summary['time'] += time.time() - start
+        stats.end_request(request)
+        line = stats.format_summary(summary)
+        stats.logger.info('%s %s' % (request.path, line))
+        if getattr(settings, 'FULLHISTORY_STATS_HEADER', False):
+            response['X-FullHistory'] = line
         return response
 
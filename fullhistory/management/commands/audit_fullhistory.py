@@ -0,0 +1,176 @@
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models
+
+def get_jobs(content_types, range_size):
+    '''
+    Splits the live rows of the registered models into (content type id, low, high) pk ranges
+    Integer pks are split on multiples of range_size so the ranges are the same on every run
+    '''
+    from django.contrib.contenttypes.models import ContentType
+    from django.db.models import get_models
+    from fullhistory.fullhistory import REGISTERED_MODELS
+    #importing the models registers them
+    get_models()
+    jobs = list()
+    for model in REGISTERED_MODELS:
+        ct = ContentType.objects.get_for_model(model)
+        if content_types and '%s.%s' % (ct.app_label, ct.model) not in content_types:
+            continue
+        if not isinstance(model._meta.pk, (models.AutoField, models.IntegerField)):
+            jobs.append((ct.pk, None, None))
+            continue
+        bounds = model._default_manager.aggregate(low=models.Min('pk'), high=models.Max('pk'))
+        if bounds['low'] is None:
+            continue
+        for start in range(bounds['low'] // range_size, bounds['high'] // range_size + 1):
+            jobs.append((ct.pk, start * range_size - 1, (start + 1) * range_size - 1))
+    return jobs
+
+def job_key(job):
+    return '%s:%s:%s' % job
+
+def audit_range(args):
+    '''
+    Audits the live rows of one pk range, run in a worker process
+    Returns the job, the number of objects checked and the mismatches found
+    '''
+    from django.contrib.contenttypes.models import ContentType
+    from fullhistory.fullhistory import REGISTERED_MODELS
+    from fullhistory.models import FullHistory
+    job, batch_size = args
+    content_type_id, low, high = job
+    ct = ContentType.objects.get_for_id(content_type_id)
+    model = ct.model_class()
+    name = '%s.%s' % (ct.app_label, ct.model)
+    #the live rows are read as values, without post_init, and their relations once per batch
+    extractor = REGISTERED_MODELS[model].extractor
+    entries = model._default_manager.order_by('pk')
+    if high is not None:
+        entries = entries.filter(pk__lte=high)
+    checked = 0
+    mismatches = list()
+    last = low
+    while True:
+        batch = entries
+        if last is not None:
+            batch = batch.filter(pk__gt=last)
+        batch = list(extractor.read_rows(batch[:batch_size]))
+        if not batch:
+            return job, checked, mismatches
+        pks = [entry.pk for entry in batch]
+        related = dict([(field, extractor.get_related_pks_many(model, field, pks))
+                        for field in extractor.many_to_many])
+        try:
+            versions = FullHistory.objects.get_versions(model, pks, audit=True, chunk_size=batch_size)
+        except AssertionError:
+            #a broken chain somewhere in the batch, find it object by object
+            versions = FullHistory.objects.get_versions(model, pks, audit=False, chunk_size=batch_size)
+            for pk in pks:
+                try:
+                    FullHistory.objects.get_version(model=model, pk=pk)
+                except (AssertionError, FullHistory.DoesNotExist), e:
+                    mismatches.append({'content_type': name,
+                                       'object_id': unicode(pk),
+                                       'error': 'chain',
+                                       'message': unicode(e)})
+        for entry in batch:
+            if entry.pk not in versions:
+                mismatches.append({'content_type': name,
+                                   'object_id': unicode(entry.pk),
+                                   'error': 'missing'})
+                continue
+            data = extractor.extract(entry, many_to_many=False)
+            for field in extractor.many_to_many:
+                data[field] = related[field][entry.pk]
+            for key, recorded, value in FullHistory.objects.compare(versions[entry.pk], entry, data):
+                mismatches.append({'content_type': name,
+                                   'object_id': unicode(entry.pk),
+                                   'error': 'value',
+                                   'attr': key,
+                                   'recorded': recorded,
+                                   'live': value})
+        checked += len(batch)
+        last = batch[-1].pk
+
+class Command(NoArgsCommand):
+    help = ("Compares the reconstructed state of every tracked object with its live row and "
+            "writes the mismatches as JSON lines.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', dest='output', default='-',
+            help='File to write the mismatches to, defaults to stdout'),
+        make_option('--content-type', action='append', dest='content_types', default=[],
+            help='Only audit this app_label.model, may be repeated'),
+        make_option('--state', dest='state', default=None,
+            help='File recording the finished ranges, an interrupted audit resumes from it'),
+        make_option('--processes', dest='processes', type='int', default=None,
+            help='Number of worker processes, defaults to the number of CPUs'),
+        make_option('--range-size', dest='range_size', type='int', default=10000,
+            help='Number of primary keys per unit of work'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help='Number of objects read and reconstructed per query'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        content_types = [name.lower() for name in options['content_types']]
+        done = set()
+        if options['state'] and os.path.exists(options['state']):
+            done = set(json.load(open(options['state'])))
+        jobs = [(job, options['batch_size']) for job in get_jobs(content_types, options['range_size'])
+                if job_key(job) not in done]
+        if options['output'] == '-':
+            output = sys.stdout
+        else:
+            #resumed audits add to the mismatches already written
+            output = open(options['output'], done and 'a' or 'w')
+        processes = options['processes']
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = min(processes, len(jobs))
+        pool = None
+        if processes > 1:
+            #the workers open their own connections
+            connection.close()
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(audit_range, jobs)
+        else:
+            results = itertools.imap(audit_range, jobs)
+        total, checked, failed = len(jobs), 0, 0
+        try:
+            for index, (job, count, mismatches) in enumerate(results):
+                for mismatch in mismatches:
+                    output.write(json.dumps(mismatch, cls=DjangoJSONEncoder))
+                    output.write('\n')
+                output.flush()
+                checked += count
+                failed += len(mismatches)
+                if options['state']:
+                    done.add(job_key(job))
+                    self.save_state(options['state'], done)
+                if verbosity > 1:
+                    sys.stderr.write('Audited %s/%s ranges, %s objects, %s mismatches\n' %
+                                     (index + 1, total, checked, failed))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if output is not sys.stdout:
+                output.close()
+        if verbosity:
+            sys.stderr.write('Audited %s objects, %s mismatches\n' % (checked, failed))
+
+    def save_state(self, path, done):
+        #write and rename so an interrupted run never leaves a truncated state file
+        temp = '%s.tmp' % path
+        stream = open(temp, 'w')
+        json.dump(sorted(done), stream)
+        stream.close()
+        os.rename(temp, path)
@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+class Command(NoArgsCommand):
+    help = ("Creates or advances the revision heads of objects recorded before heads existed "
+            "and copies the user of each request onto its histories.")
+
+    def handle_noargs(self, **options):
+        from fullhistory.models import FullHistory, HistoryHead
+        changed = HistoryHead.objects.rebuild()
+        transaction.commit_unless_managed()
+        if int(options.get('verbosity', 1)):
+            print "Updated %s history heads" % changed
+        updated = FullHistory.objects.backfill_users()
+        if int(options.get('verbosity', 1)):
+            print "Copied the user of %s histories" % updated
@@ -0,0 +1,97 @@
+import datetime
+import multiprocessing
+import os
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.conf import settings
+from django.db import connection, transaction
+
+def get_policies():
+    '''
+    Returns (content type, days, period) for every model covered by FULLHISTORY_RETENTION
+    '''
+    from django.contrib.contenttypes.models import ContentType
+    from django.db.models import get_models
+    from fullhistory.fullhistory import REGISTERED_MODELS
+    from fullhistory.models import RETENTION_PERIODS
+    #importing the models registers them
+    get_models()
+    retention = getattr(settings, 'FULLHISTORY_RETENTION', {})
+    policies = list()
+    for model in REGISTERED_MODELS:
+        name = '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+        policy = retention.get(name, retention.get('*'))
+        if policy is None:
+            continue
+        period = policy.get('snapshots', 'month')
+        if period not in RETENTION_PERIODS:
+            raise CommandError('Unknown snapshot period %s for %s' % (period, name))
+        ct = ContentType.objects.get_for_model(model)
+        policies.append((ct.pk, policy['days'], period))
+    return policies
+
+def compact_content_type(args):
+    '''
+    Compacts the histories of one content type, run in a worker process
+    '''
+    from django.contrib.contenttypes.models import ContentType
+    from fullhistory.archive import ArchiveWriter, open_archive
+    from fullhistory.models import FullHistory
+    content_type_id, before, period, archive_dir, chunk_size = args
+    archive = None
+    if archive_dir:
+        ct = ContentType.objects.get_for_id(content_type_id)
+        path = os.path.join(archive_dir, '%s.%s-%s.jsonl.gz' % (ct.app_label, ct.model,
+                                                                before.strftime('%Y%m%d%H%M%S')))
+        archive = ArchiveWriter(open_archive(path, 'wb'))
+    try:
+        removed = FullHistory.objects.compact(content_type_id, before, period, archive, chunk_size)
+    finally:
+        if archive is not None:
+            archive.close()
+    transaction.commit_unless_managed()
+    return content_type_id, removed
+
+class Command(NoArgsCommand):
+    help = ("Collapses histories older than the FULLHISTORY_RETENTION policies into one snapshot "
+            "per period, deleting or archiving the superseded rows.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--archive-dir', dest='archive_dir', default=None,
+            help='Write the removed histories to one archive per model in this directory'),
+        make_option('--processes', dest='processes', type='int', default=None,
+            help='Number of worker processes, defaults to the number of CPUs'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+            help='Number of objects to compact per transaction'),
+    )
+
+    def handle_noargs(self, **options):
+        from django.contrib.contenttypes.models import ContentType
+        verbosity = int(options.get('verbosity', 1))
+        now = datetime.datetime.now()
+        jobs = [(content_type_id, now - datetime.timedelta(days=days), period,
+                 options['archive_dir'], options['chunk_size'])
+                for content_type_id, days, period in get_policies()]
+        if not jobs:
+            if verbosity:
+                print "No models have a retention policy, set FULLHISTORY_RETENTION"
+            return
+        processes = options['processes']
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = min(processes, len(jobs))
+        if processes > 1:
+            #the workers open their own connections
+            connection.close()
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(compact_content_type, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(compact_content_type, jobs)
+        if verbosity:
+            for content_type_id, removed in results:
+                ct = ContentType.objects.get_for_id(content_type_id)
+                print "Removed %s %s.%s histories" % (removed, ct.app_label, ct.model)
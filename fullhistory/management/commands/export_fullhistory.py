@@ -0,0 +1,69 @@
+import datetime
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+def parse_time(value):
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise CommandError('Invalid date %s, use YYYY-MM-DD or "YYYY-MM-DD HH:MM:SS"' % value)
+
+class Command(NoArgsCommand):
+    help = ("Streams history rows to gzip compressed JSON lines. Each Request is written once, "
+            "before the first history that refers to it.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', dest='output', default='-',
+            help='File to write to, defaults to stdout'),
+        make_option('--content-type', action='append', dest='content_types', default=[],
+            help='Only export histories of this app_label.model, may be repeated'),
+        make_option('--since', dest='since', default=None,
+            help='Only export histories recorded at or after this date'),
+        make_option('--until', dest='until', default=None,
+            help='Only export histories recorded before this date'),
+        make_option('--site', dest='site', type='int', default=None,
+            help='Only export histories of this site id'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Number of rows to read per query'),
+    )
+
+    def handle_noargs(self, **options):
+        from django.contrib.contenttypes.models import ContentType
+        from fullhistory.archive import ArchiveWriter, open_archive
+        from fullhistory.models import FullHistory
+        histories = FullHistory.objects.all()
+        if options['content_types']:
+            cts = list()
+            for name in options['content_types']:
+                try:
+                    app_label, model = name.lower().split('.')
+                    cts.append(ContentType.objects.get(app_label=app_label, model=model))
+                except (ValueError, ContentType.DoesNotExist):
+                    raise CommandError('Unknown content type %s' % name)
+            histories = histories.filter(content_type__in=cts)
+        if options['since']:
+            histories = histories.filter(action_time__gte=parse_time(options['since']))
+        if options['until']:
+            histories = histories.filter(action_time__lt=parse_time(options['until']))
+        if options['site'] is not None:
+            histories = histories.filter(site=options['site'])
+
+        archive = ArchiveWriter(open_archive(options['output'], 'wb'))
+        last = 0
+        try:
+            while True:
+                chunk = list(histories.filter(pk__gt=last).order_by('pk')[:options['chunk_size']])
+                if not chunk:
+                    break
+                archive.write_histories(chunk)
+                last = chunk[-1].pk
+                if int(options.get('verbosity', 1)) > 1:
+                    sys.stderr.write('Exported %s histories\n' % archive.count)
+        finally:
+            archive.close()
+        if int(options.get('verbosity', 1)):
+            sys.stderr.write('Exported %s histories and %s requests\n' % (archive.count, 
+                                                                        archive.request_count))
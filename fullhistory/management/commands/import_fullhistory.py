@@ -0,0 +1,103 @@
+from django.core.management.base import LabelCommand, CommandError
+from django.db import connection, transaction
+from optparse import make_option
+
+class Command(LabelCommand):
+    help = "Loads history rows written by export_fullhistory, inserting them in chunks."
+    args = '[archive.jsonl.gz ...]'
+    label = 'archive'
+    option_list = LabelCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Number of histories to insert per statement'),
+    )
+
+    def handle_label(self, path, **options):
+        from fullhistory.archive import open_archive, read_archive
+        stream = open_archive(path)
+        self.content_types = dict()
+        #archive request id to (new pk, user pk), the requests themselves are not kept
+        self.requests = dict()
+        pending_requests = list()
+        chunk = list()
+        count = 0
+        try:
+            for row in read_archive(stream):
+                if row['type'] == 'request':
+                    #requests forgotten by the exporter are written again
+                    if row['id'] not in self.requests:
+                        pending_requests.append(row)
+                    continue
+                chunk.append(row)
+                if len(chunk) >= options['chunk_size']:
+                    count += self.insert(chunk, pending_requests)
+                    chunk, pending_requests = list(), list()
+            count += self.insert(chunk, pending_requests)
+        finally:
+            stream.close()
+        if int(options.get('verbosity', 1)):
+            print "Imported %s histories and %s requests from %s" % (count, len(self.requests), path)
+
+    def insert_requests(self, rows):
+        '''
+        Inserts requests with one statement and maps their archive ids to the new rows
+        The new rows are found by their values among the rows added after the insert started
+        '''
+        from fullhistory.models import Request
+        rows = dict([(row['id'], row) for row in rows if row['id'] not in self.requests]).values()
+        if not rows:
+            return
+        qn = connection.ops.quote_name
+        table = qn(Request._meta.db_table)
+        cursor = connection.cursor()
+        cursor.execute('SELECT MAX(id) FROM %s' % table)
+        last = cursor.fetchone()[0] or 0
+        cursor.executemany('INSERT INTO %s (user_name, user_pk, request_path) VALUES (%%s, %%s, %%s)' % table,
+                           [(row['user_name'], row['user_pk'], row['request_path']) for row in rows])
+        waiting = dict()
+        for row in rows:
+            key = (row['user_name'], row['user_pk'], row['request_path'])
+            waiting.setdefault(key, list()).append(row['id'])
+        cursor.execute('SELECT id, user_name, user_pk, request_path FROM %s WHERE id > %%s ORDER BY id' % table,
+                       [last])
+        for pk, user_name, user_pk, request_path in cursor.fetchall():
+            ids = waiting.get((user_name, user_pk, request_path))
+            if ids:
+                self.requests[ids.pop(0)] = (pk, user_pk)
+
+    def build_history(self, row):
+        from django.contrib.contenttypes.models import ContentType
+        from fullhistory.models import FullHistory
+        if row['content_type'] not in self.content_types:
+            app_label, model = row['content_type'].split('.')
+            try:
+                ct = ContentType.objects.get(app_label=app_label, model=model)
+            except ContentType.DoesNotExist:
+                raise CommandError('Unknown content type %s' % row['content_type'])
+            self.content_types[row['content_type']] = ct.pk
+        request_id, user_pk = self.requests.get(row['request'], (None, None))
+        history = FullHistory(content_type_id=self.content_types[row['content_type']],
+                              object_id=row['object_id'],
+                              revision=row['revision'],
+                              request_id=request_id,
+                              user_pk=user_pk,
+                              site_id=row['site'],
+                              action=row['action'],
+                              info=row['info'])
+        history._data = row['data']
+        history.action_time = FullHistory._meta.get_field('action_time').to_python(row['action_time'])
+        return history
+
+    def insert(self, rows, requests):
+        from fullhistory.models import FullHistory, HistoryHead
+        if not rows and not requests:
+            return 0
+        self.insert_requests(requests)
+        chunk = [self.build_history(row) for row in rows]
+        FullHistory.objects.insert_rows(chunk, raw=True)
+        for content_type_id in set([history.content_type_id for history in chunk]):
+            object_ids = list(set([history.object_id for history in chunk
+                                   if history.content_type_id == content_type_id]))
+            for start in range(0, len(object_ids), 500):
+                HistoryHead.objects.rebuild_objects(content_type_id, object_ids[start:start+500])
+        transaction.commit_unless_managed()
+        return len(chunk)
@@ -0,0 +1,69 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import transaction
+
+class Command(NoArgsCommand):
+    help = "Re-encodes the stored history data with another codec, or reports how the codecs compare."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--codec', dest='codec', default=None,
+            help='Codec to encode with, defaults to FULLHISTORY_CODEC'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+            help='Number of rows to re-encode per transaction'),
+        make_option('--stats', action='store_true', dest='stats', default=False,
+            help='Report size and encode/decode throughput of each codec instead of re-encoding'),
+        make_option('--sample', dest='sample', type='int', default=1000,
+            help='Number of rows to measure with --stats'),
+    )
+
+    def handle_noargs(self, **options):
+        from fullhistory import encoders
+        from fullhistory.models import FullHistory, HistoryCheckpoint
+        if options['codec'] is not None and options['codec'] not in encoders.CODECS:
+            raise CommandError('Unknown codec %s, choose from %s' % 
+                               (options['codec'], ', '.join(sorted(encoders.CODECS))))
+        if options['stats']:
+            return self.report(FullHistory, options['sample'])
+        verbosity = int(options.get('verbosity', 1))
+        codec = encoders.get_codec(options['codec'])
+        for model in (FullHistory, HistoryCheckpoint):
+            changed = self.reencode(model, codec, options['chunk_size'])
+            if verbosity:
+                print "Re-encoded %s %s rows" % (changed, model._meta.object_name)
+
+    def reencode(self, model, codec, chunk_size):
+        from fullhistory import encoders
+        changed = 0
+        last = 0
+        while True:
+            rows = list(model.objects.filter(pk__gt=last).order_by('pk').values_list('pk', '_data')[:chunk_size])
+            if not rows:
+                return changed
+            for pk, text in rows:
+                new_text = codec.encode(encoders.decode(text))
+                if new_text != text:
+                    model.objects.filter(pk=pk).update(_data=new_text)
+                    changed += 1
+            transaction.commit_unless_managed()
+            last = rows[-1][0]
+
+    def report(self, model, sample):
+        from fullhistory import encoders
+        values = [encoders.decode(text) for text in 
+                  model.objects.order_by('-pk').values_list('_data', flat=True)[:sample]]
+        if not values:
+            print "No history rows to measure"
+            return
+        print "%-10s %12s %14s %14s" % ('codec', 'bytes', 'encode rows/s', 'decode rows/s')
+        for name in sorted(encoders.CODECS):
+            codec = encoders.CODECS[name]
+            start = time.time()
+            texts = [codec.encode(value) for value in values]
+            encode_time = max(time.time() - start, 1e-6)
+            start = time.time()
+            for text in texts:
+                encoders.decode(text)
+            decode_time = max(time.time() - start, 1e-6)
+            print "%-10s %12d %14d %14d" % (name, sum([len(text) for text in texts]),
+                                            len(values) / encode_time, len(values) / decode_time)
@@ -0,0 +1,68 @@
+from __future__ import with_statement
+
+from django.db import models
+from django.db.models.query import QuerySet
+
+import fullhistory
+
+class HistoryQuerySet(QuerySet):
+    '''
+    QuerySet for registered models that records the history of bulk operations
+    Histories are buffered and written with one bulk insert
+    '''
+    def update(self, **kwargs):
+        '''
+        Reads the rows once before and once after the update and records what changed
+        Many to many relations and parent tables are not affected by update and not compared
+        '''
+        extractor = fullhistory.REGISTERED_MODELS[self.model].extractor
+        #a clone so rows cached by an earlier evaluation are not taken for the current ones
+        before = dict([(obj.pk, obj) for obj in extractor.read_rows(self._clone())])
+        rows = super(HistoryQuerySet, self).update(**kwargs)
+        if not before:
+            return rows
+        pks = before.keys()
+        with fullhistory.buffered() as session:
+            for start in range(0, len(pks), 500):
+                queryset = self.model._default_manager.filter(pk__in=pks[start:start+500])
+                for obj in extractor.read_rows(queryset):
+                    olddata = extractor.extract(before[obj.pk], many_to_many=False)
+                    newdata = extractor.extract(obj, many_to_many=False)
+                    data = dict([(key, (value, newdata[key])) for key, value in olddata.items()
+                                 if value != newdata[key]])
+                    if data:
+                        history = fullhistory.new_history(obj,
+                                                          data=data,
+                                                          action='U',
+                                                          request=fullhistory.get_or_create_request())
+                        session.pending.append((history, obj))
+        return rows
+    update.alters_data = True
+
+    def delete(self):
+        '''
+        Deletes the objects, their histories are recorded through the delete
+        signals and written together
+        '''
+        with fullhistory.buffered():
+            super(HistoryQuerySet, self).delete()
+    delete.alters_data = True
+
+    def bulk_create(self, objs):
+        '''
+        Saves new objects, recording their histories with one bulk insert
+        '''
+        with fullhistory.buffered():
+            for obj in objs:
+                obj.save(force_insert=True)
+        return objs
+
+class HistoryManager(models.Manager):
+    '''
+    Manager for registered models whose bulk operations should be recorded
+    '''
+    def get_query_set(self):
+        return HistoryQuerySet(self.model)
+
+    def bulk_create(self, objs):
+        return self.get_query_set().bulk_create(objs)
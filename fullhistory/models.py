@@ -1,15 +1,45 @@
-from django.db import models
+from django.db import models, transaction, connection, IntegrityError
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-from django.core.serializers.json import DjangoJSONEncoder
-import json
+from django.conf import settings
+import encoders
+import cache
+from serializers import values_match
 
 import datetime
 
-ENCODER = DjangoJSONEncoder()
+#how old histories are grouped when compacting, the last revision of each group is kept
+RETENTION_PERIODS = {
+    'day': lambda when: when.date(),
+    'week': lambda when: when.isocalendar()[:2],
+    'month': lambda when: (when.year, when.month),
+    'year': lambda when: when.year,
+    None: lambda when: None,
+}
+
+def in_transaction(func, *args, **kwargs):
+    '''
+    Calls func in a transaction of its own unless the caller already manages one
+    Revisions are allocated by updating the head row, the row stays locked until
+    the transaction ends so the update, its read back and the insert have to share it
+    '''
+    if transaction.is_managed():
+        return func(*args, **kwargs)
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        try:
+            ret = func(*args, **kwargs)
+        except:
+            transaction.rollback()
+            raise
+        transaction.commit()
+        return ret
+    finally:
+        transaction.leave_transaction_management()
 
 class Request(models.Model):
     user_name = models.CharField(max_length=255, blank=True, null=True)
@@ -29,8 +59,51 @@ class Request(models.Model):
         return self.request_path
 
 class FullHistoryManager(models.Manager):
-    def user_actions(self, user):
-        return self.get_query_set().filter(user_pk=user.pk)
+    def user_actions(self, user, since=None, until=None, before=None):
+        '''
+        Returns the changes made by user, newest first
+        since and until limit action_time to [since, until)
+        Pass the last history of a page as before to get the page after it
+        '''
+        histories = self.get_query_set().filter(user_pk=user.pk)
+        if since is not None:
+            histories = histories.filter(action_time__gte=since)
+        if until is not None:
+            histories = histories.filter(action_time__lt=until)
+        if before is not None:
+            histories = histories.filter(models.Q(action_time__lt=before.action_time) |
+                                         models.Q(action_time=before.action_time, pk__lt=before.pk),
+                                         action_time__lte=before.action_time)
+        return histories.order_by('-action_time', '-pk')
+
+    def backfill_users(self, chunk_size=10000):
+        '''
+        Copies user_pk from the requests of histories recorded before it was stored on them
+        Works through the table in primary key ranges, returns the number of rows updated
+        '''
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        sql = ('UPDATE %(table)s SET %(user_pk)s = (SELECT %(rq_user_pk)s FROM %(rq_table)s '
+               'WHERE %(rq_table)s.%(rq_pk)s = %(table)s.%(request)s) '
+               'WHERE %(user_pk)s IS NULL AND %(pk)s > %%s AND %(pk)s <= %%s AND %(request)s IN '
+               '(SELECT %(rq_pk)s FROM %(rq_table)s WHERE %(rq_user_pk)s IS NOT NULL)' % 
+               {'table': qn(opts.db_table),
+                'user_pk': qn(opts.get_field('user_pk').column),
+                'request': qn(opts.get_field('request').column),
+                'pk': qn(opts.pk.column),
+                'rq_table': qn(Request._meta.db_table),
+                'rq_user_pk': qn(Request._meta.get_field('user_pk').column),
+                'rq_pk': qn(Request._meta.pk.column)})
+        bounds = self.get_query_set().aggregate(models.Min('pk'), models.Max('pk'))
+        if bounds['pk__min'] is None:
+            return 0
+        cursor = connection.cursor()
+        updated = 0
+        for start in range(bounds['pk__min'] - 1, bounds['pk__max'], chunk_size):
+            cursor.execute(sql, [start, start + chunk_size])
+            updated += cursor.rowcount
+            transaction.commit_unless_managed()
+        return updated
     
     def actions_for_object(self, entry=None, model=None, pk=None):
         '''
@@ -52,56 +125,680 @@ class FullHistoryManager(models.Manager):
         '''
         obj = self.get_version(entry, model, pk)
         if entry is not None:
-            from fullhistory import REGISTERED_MODELS
-            handler = REGISTERED_MODELS[type(entry)]
-            for key, value in handler.get_all_data(entry).items():
-                #!Truncates microseconds for datetime fields
-                if isinstance(value, datetime.datetime):
-                    value = str(value.replace(microsecond=0))
-                assert obj[key] == value, ('%s does not match %s for attr %s' % 
-                                           (obj[key], value, key))
+            for key, recorded, value in self.compare(obj, entry):
+                assert False, ('%s does not match %s for attr %s' % 
+                               (recorded, value, key))
         return obj
+
+    def compare(self, obj, entry, data=None):
+        '''
+        Compares a reconstructed state with the live entry
+        Returns a list of (attr, recorded value, live value) for the values that differ
+        Hashed values are compared with the hash of the other side
+        ``data`` is the live data of the entry if it was already extracted
+        '''
+        if data is None:
+            from fullhistory import REGISTERED_MODELS
+            data = REGISTERED_MODELS[type(entry)].get_all_data(entry)
+        mismatches = list()
+        for key, value in data.items():
+            #!Truncates microseconds for datetime fields
+            if isinstance(value, datetime.datetime):
+                value = str(value.replace(microsecond=0))
+            recorded = obj.get(key)
+            if isinstance(value, list) and isinstance(recorded, list):
+                #related objects are not read in any particular order
+                matches = sorted(value) == sorted(recorded)
+            else:
+                matches = key in obj and values_match(recorded, value)
+            if not matches:
+                mismatches.append((key, recorded, value))
+        return mismatches
     
     def get_version(self, entry=None, model=None, 
                     pk=None, version=None, audit=True):
         '''
         Returns a dictionary representing the object at a given version
         '''
-        if version is None:
-            histories = self.actions_for_object(entry, model, pk)
+        if entry:
+            pk = entry.pk
+            ct = ContentType.objects.get_for_model(entry)
+        else:
+            ct = ContentType.objects.get_for_model(model)
+        return self.reconstruct(ct, pk, version, audit)
+
+    def reconstruct(self, content_type, object_id, version=None, audit=True):
+        '''
+        Rebuilds the state of an object starting from the nearest checkpoint
+        at or below the requested version and replaying the remaining deltas
+        Raises FullHistory.DoesNotExist if nothing is recorded at or below the version
+        Without audit, versions are served from and stored in the version cache if it is enabled
+        '''
+        use_cache = version is not None and not audit
+        if use_cache:
+            obj = cache.get_version(content_type, object_id, version)
+            if obj is not None:
+                return obj
+        histories = self.get_query_set().filter(content_type=content_type, 
+                                                object_id=object_id).order_by('revision')
+        if version is not None:
+            histories = histories.filter(revision__lte=version)
+        checkpoint = HistoryCheckpoint.objects.nearest(content_type, object_id, version)
+        if checkpoint is None:
+            histories = list(histories)
+            if not histories:
+                #never recorded, or compacted away before the first snapshot that was kept
+                raise self.model.DoesNotExist('No history of %s at or before revision %s' % 
+                                              (object_id, version))
+            if audit:
+                assert histories[0].action == 'C', 'First action should be create'
+            obj = dict()
+        else:
+            histories = list(histories.filter(revision__gt=checkpoint.revision))
+            obj = checkpoint.data
+        obj = self.replay(obj, histories, audit)
+        if use_cache:
+            if histories:
+                last = histories[-1].revision
+            else:
+                last = getattr(checkpoint, 'revision', None)
+            #revisions that do not exist yet must not be cached
+            if last == int(version):
+                cache.set_version(content_type, object_id, version, obj)
+        return obj
+
+    def diff(self, entry=None, model=None, pk=None, from_version=None, to_version=None):
+        '''
+        Returns the net change between two versions as a dictionary of attr to (old value, new value)
+        Only the histories after from_version up to to_version are read and their deltas composed,
+        values that changed and changed back are left out
+        from_version defaults to before the object was created and to_version to the latest version
+        '''
+        if entry:
+            pk = entry.pk
+            ct = ContentType.objects.get_for_model(entry)
+        else:
+            ct = ContentType.objects.get_for_model(model)
+        if from_version is None:
+            from_version = -1
+        if to_version is not None and to_version < from_version:
+            return dict([(key, (new, old)) for key, (old, new) in 
+                         self.diff(entry, model, pk, to_version, from_version).items()])
+        histories = self.get_query_set().filter(content_type=ct, object_id=pk, 
+                                                revision__gt=from_version).order_by('revision')
+        if to_version is not None:
+            histories = histories.filter(revision__lte=to_version)
+        histories = decode_histories(histories)
+        if [history.revision for history in histories] != range(from_version + 1, 
+                                                                from_version + 1 + len(histories)):
+            #compacted deltas are missing, compare the versions themselves
+            before = dict()
+            if from_version >= 0:
+                before = self.reconstruct(ct, pk, from_version, audit=False)
+            after = self.reconstruct(ct, pk, to_version, audit=False)
+            changes = dict([(key, (before.get(key), after.get(key))) 
+                            for key in set(before.keys()) | set(after.keys())])
+        else:
+            changes = dict()
+            unknown = list()
+            for history in histories:
+                if history.data is None:
+                    continue
+                for key, value in history.data.items():
+                    if key in changes:
+                        changes[key] = (changes[key][0], value[-1])
+                    elif len(value) == 2:
+                        changes[key] = tuple(value)
+                    else:
+                        #creates only record the new value
+                        changes[key] = (None, value[0])
+                        unknown.append(key)
+            if unknown and from_version >= 0:
+                before = self.reconstruct(ct, pk, from_version, audit=False)
+                for key in unknown:
+                    changes[key] = (before.get(key), changes[key][1])
+        return dict([(key, value) for key, value in changes.items() if value[0] != value[1]])
+
+    def get_versions(self, model=None, pks=None, version=None, entries=None, 
+                     audit=True, chunk_size=500):
+        '''
+        Returns a dictionary of pk to the state of each object at a given version
+        Requires either entries or model and pks
+        The histories are read with one query per chunk of chunk_size objects
+        '''
+        if entries is not None:
+            entries = list(entries)
+            if not entries:
+                return dict()
+            model = type(entries[0])
+            pks = [entry.pk for entry in entries]
+        ct = ContentType.objects.get_for_model(model)
+        object_ids = dict([(unicode(pk), pk) for pk in pks])
+        keys = object_ids.keys()
+        ret = dict()
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start+chunk_size]
+            checkpoints = HistoryCheckpoint.objects.filter(content_type=ct, object_id__in=chunk)
+            histories = self.get_query_set().filter(content_type=ct, object_id__in=chunk)
+            if version is not None:
+                checkpoints = checkpoints.filter(revision__lte=version)
+                histories = histories.filter(revision__lte=version)
+            nearest = dict()
+            for checkpoint in checkpoints:
+                if checkpoint.revision > getattr(nearest.get(checkpoint.object_id), 'revision', -1):
+                    nearest[checkpoint.object_id] = checkpoint
+            if len(nearest) == len(chunk):
+                histories = histories.filter(revision__gt=min([cp.revision for cp in nearest.values()]))
+            object_id, obj, floor = None, None, -1
+            for history in decode_histories(histories.order_by('object_id', 'revision')):
+                if history.object_id != object_id:
+                    object_id = history.object_id
+                    checkpoint = nearest.get(object_id)
+                    if checkpoint is None:
+                        if audit:
+                            assert history.action == 'C', 'First action should be create'
+                        obj, floor = dict(), -1
+                    else:
+                        obj, floor = checkpoint.data, checkpoint.revision
+                    ret[object_ids[object_id]] = obj
+                if history.revision > floor:
+                    self.apply_history(obj, history, audit)
+            for object_id, checkpoint in nearest.items():
+                if object_ids[object_id] not in ret:
+                    ret[object_ids[object_id]] = checkpoint.data
+        return ret
+
+    def replay(self, obj, histories, audit=True):
+        '''
+        Applies the deltas of the given histories on top of obj
+        '''
+        for history in decode_histories(histories):
+            self.apply_history(obj, history, audit)
+        return obj
+
+    def apply_history(self, obj, history, audit=True):
+        '''
+        Applies the delta of a single history on top of obj
+        '''
+        if history.data is None:
+            assert history.action == 'D'
+            return obj
+        for key, value in history.data.items():
+            if len(value) == 2:
+                if audit:
+                    assert values_match(obj[key], value[0]), ('%s does not match %s for attr %s' % 
+                                                  (obj[key], value[0], key))
+                obj[key] = value[1]
+            else:
+                obj[key] = value[0]
+        return obj
+
+    def iterate_objects(self, histories, chunk_size=1000):
+        '''
+        Yields the given histories ordered by object and revision, reading them in
+        keyset paginated chunks so memory stays bounded
+        '''
+        histories = histories.order_by('object_id', 'revision')
+        chunk = decode_histories(histories[:chunk_size])
+        while chunk:
+            for history in chunk:
+                yield history
+            last = chunk[-1]
+            chunk = decode_histories(histories.filter(models.Q(object_id__gt=last.object_id) |
+                                                      models.Q(object_id=last.object_id, 
+                                                               revision__gt=last.revision))[:chunk_size])
+
+    def as_of(self, model, timestamp, instances=False, chunk_size=1000):
+        '''
+        Yields (pk, state) for every object of model that existed at timestamp
+        With instances the state is returned as an unsaved model instance
+        The history of the model is read once in chunks of chunk_size rows
+        '''
+        ct = ContentType.objects.get_for_model(model)
+        histories = self.get_query_set().filter(content_type=ct, action_time__lte=timestamp)
+        object_id, state, revision = None, None, None
+        for history in self.iterate_objects(histories, chunk_size):
+            if history.object_id != object_id:
+                if state is not None:
+                    yield self.as_of_result(model, object_id, state, instances)
+                object_id, state, revision = history.object_id, dict(), None
+            gap = revision is None or history.revision != revision + 1
+            revision = history.revision
+            if history.action == 'D':
+                state = None
+                continue
+            if history.action == 'C' or state is None:
+                state = dict()
+            if gap and history.action != 'C':
+                #compacted deltas are missing, start from the checkpoint kept with this revision
+                checkpoint = HistoryCheckpoint.objects.nearest(ct, object_id, history.revision)
+                if checkpoint is not None and checkpoint.revision == history.revision:
+                    state = checkpoint.data
+                    continue
+            self.apply_history(state, history, audit=False)
+        if state is not None:
+            yield self.as_of_result(model, object_id, state, instances)
+
+    def as_of_result(self, model, object_id, state, instances):
+        if instances:
+            from fullhistory import REGISTERED_MODELS
+            return model._meta.pk.to_python(object_id), REGISTERED_MODELS[model].get_object(state).object
+        return model._meta.pk.to_python(object_id), state
+
+    def bulk_save(self, histories):
+        '''
+        Allocates revisions for and inserts unsaved histories with as few statements as possible
+        Returns the heads of the objects that were written to
+        '''
+        return in_transaction(self.allocate_and_insert, histories)
+
+    def allocate_and_insert(self, histories):
+        groups = dict()
+        for history in histories:
+            key = (history.content_type_id, unicode(history.object_id))
+            groups.setdefault(key, list()).append(history)
+        heads = list()
+        for history in histories:
+            history.save_request()
+        allocated = HistoryHead.objects.allocate_many(dict([
+            (key, (len(group), sum([len(history._data) for history in group]), group[0].action == 'C'))
+            for key, group in groups.items()]))
+        for (content_type_id, object_id), group in groups.items():
+            head = allocated[(content_type_id, object_id)]
+            for index, history in enumerate(group):
+                history.object_id = object_id
+                history.revision = head.revision - len(group) + index + 1
+                if not history.info:
+                    history.info = history.create_info()
+            heads.append(head)
+        self.insert_rows(histories)
+        return heads
+
+    def insert_rows(self, histories, raw=False):
+        '''
+        Inserts histories that already have their revision set and fills in their primary keys
+        With raw the field values are stored as they are, for importing, and primary keys are not read back
+        '''
+        if not histories:
+            return
+        opts = self.model._meta
+        fields = [field for field in opts.local_fields if not isinstance(field, models.AutoField)]
+        qn = connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(opts.db_table), 
+                                                   ', '.join([qn(field.column) for field in fields]),
+                                                   ', '.join(['%s'] * len(fields)))
+        if raw:
+            params = [[field.get_db_prep_save(getattr(history, field.attname)) for field in fields] 
+                      for history in histories]
         else:
-            histories = self.actions_for_object(entry, model, pk).filter(revision__lte=version)
-        if audit:
-            assert histories[0].action == 'C', 'First action should be create'
-        obj = dict()
+            params = [[field.get_db_prep_save(field.pre_save(history, True)) for field in fields] 
+                      for history in histories]
+        cursor = connection.cursor()
+        cursor.executemany(sql, params)
+        transaction.commit_unless_managed()
+        if raw:
+            return
+        lookup = dict()
         for history in histories:
-            if history.data is None:
-                assert history.action == 'D'
+            lookup[(history.content_type_id, history.object_id, history.revision)] = history
+        object_ids = list(set([history.object_id for history in histories]))
+        for start in range(0, len(object_ids), 500):
+            rows = self.get_query_set().filter(content_type__in=list(set([key[0] for key in lookup])),
+                                               object_id__in=object_ids[start:start+500],
+                                               revision__in=list(set([key[2] for key in lookup])))
+            for pk, content_type_id, object_id, revision in rows.values_list('pk', 'content_type', 
+                                                                             'object_id', 'revision'):
+                history = lookup.get((content_type_id, object_id, revision))
+                if history is not None:
+                    history.pk = pk
+
+    def compact(self, content_type, before, period='month', archive=None, chunk_size=500):
+        '''
+        Collapses the histories of a content type recorded before the given time
+        The last revision of each period (see RETENTION_PERIODS) is kept with a checkpoint of
+        the full state so later revisions still reconstruct, the other rows are deleted
+        Deleted rows are written to archive (an archive.ArchiveWriter) if given
+        Returns the number of histories that were removed
+        '''
+        key = RETENTION_PERIODS[period]
+        old = self.get_query_set().filter(content_type=content_type, action_time__lt=before)
+        object_ids = old.values_list('object_id', flat=True).distinct().order_by('object_id')
+        removed = 0
+        last = None
+        while True:
+            chunk = object_ids
+            if last is not None:
+                chunk = chunk.filter(object_id__gt=last)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                return removed
+            rows = old.filter(object_id__in=chunk).order_by('object_id', 'revision')
+            kept = dict()
+            remove = dict()
+            for pk, object_id, revision, action_time in rows.values_list('pk', 'object_id',
+                                                                         'revision', 'action_time'):
+                periods = kept.setdefault(object_id, dict())
+                previous = periods.get(key(action_time))
+                if previous is not None:
+                    remove.setdefault(object_id, list()).append(previous)
+                periods[key(action_time)] = (pk, revision)
+            for object_id, superseded in remove.items():
+                keep = sorted([revision for pk, revision in kept[object_id].values()])
+                self.checkpoint_revisions(content_type, object_id, keep)
+                pks = [pk for pk, revision in superseded]
+                for start in range(0, len(pks), chunk_size):
+                    histories = self.get_query_set().filter(pk__in=pks[start:start+chunk_size])
+                    if archive is not None:
+                        archive.write_histories(list(histories.order_by('pk')))
+                    histories.delete()
+                HistoryCheckpoint.objects.filter(content_type=content_type,
+                                                 object_id=object_id,
+                                                 revision__in=[revision for pk, revision in superseded]).delete()
+                removed += len(pks)
+            transaction.commit_unless_managed()
+            last = chunk[-1]
+
+    def checkpoint_revisions(self, content_type, object_id, revisions):
+        '''
+        Makes sure a checkpoint exists at each of the given ascending revisions
+        '''
+        existing = set(HistoryCheckpoint.objects.filter(content_type=content_type,
+                                                        object_id=object_id,
+                                                        revision__in=revisions).values_list('revision', flat=True))
+        obj, current = None, None
+        for revision in revisions:
+            if revision in existing:
                 continue
-            for key, value in history.data.items():
-                if len(value) == 2:
-                    if audit:
-                        assert obj[key] == value[0], ('%s does not match %s for attr %s' % 
-                                                      (obj[key], value[0], key))
-                    obj[key] = value[1]
-                else:
-                    obj[key] = value[0]
-        return obj
-    
+            if obj is None:
+                obj = self.reconstruct(content_type, object_id, revision, audit=False)
+            else:
+                self.replay(obj, self.get_query_set().filter(content_type=content_type,
+                                                             object_id=object_id,
+                                                             revision__gt=current,
+                                                             revision__lte=revision).order_by('revision'),
+                            audit=False)
+            current = revision
+            HistoryCheckpoint.objects.create(content_type_id=getattr(content_type, 'pk', content_type),
+                                             object_id=object_id,
+                                             revision=revision,
+                                             data=obj)
+
     def rollback(self, entry=None, model=None, pk=None, 
                  version=None, commit=True, audit=True):
         '''
         Rollback an object to a certain revision number
+        Hashed and skipped fields keep their live values
         '''
         from fullhistory import REGISTERED_MODELS
         data = self.get_version(entry, model, pk, version, audit)
         if model is None:
             model = type(entry)
-        obj = REGISTERED_MODELS[model].get_object(data)
+        if entry is None:
+            try:
+                entry = model._default_manager.get(pk=pk)
+            except model.DoesNotExist:
+                pass
+        obj = REGISTERED_MODELS[model].get_object(data, entry)
         if commit:
             obj.save()
         return obj
 
+class HistoryHeadManager(models.Manager):
+    def allocate(self, content_type_id, object_id, count=1, size=0, created=False):
+        '''
+        Reserves the next ``count`` revisions for an object and returns its head
+        The head row is locked by the update until the transaction ends, so call it
+        through in_transaction together with the insert of the histories
+        ``size`` is added to the bytes written since the last checkpoint
+        With ``created`` the object was just created and its head is inserted
+        right away, falling back to the update if it already exists
+        Objects written before heads were introduced are seeded by backfill_fullhistory,
+        or from their latest revision on their first update
+        '''
+        heads = self.get_query_set().filter(content_type=content_type_id, object_id=object_id)
+        if not created and heads.update(revision=models.F('revision') + count, 
+                                        pending_bytes=models.F('pending_bytes') + size):
+            return heads.get()
+        last = -1
+        if not created:
+            last = FullHistory.objects.filter(content_type=content_type_id, 
+                                              object_id=object_id).aggregate(models.Max('revision'))['revision__max']
+            if last is None:
+                last = -1
+        head = self.model(content_type_id=content_type_id, 
+                          object_id=object_id, 
+                          revision=last + count,
+                          pending_bytes=size)
+        sid = transaction.savepoint()
+        try:
+            head.save(force_insert=True)
+        except IntegrityError:
+            #another writer created the head first or the object reuses the pk of a deleted one
+            transaction.savepoint_rollback(sid)
+            heads.update(revision=models.F('revision') + count, 
+                         pending_bytes=models.F('pending_bytes') + size)
+            return heads.get()
+        transaction.savepoint_commit(sid)
+        return head
+
+    def allocate_many(self, allocations, chunk_size=150):
+        '''
+        Same as allocate for many objects, ``allocations`` maps (content type id, object id)
+        to (count, size, created) and the heads are returned in a dictionary with the same keys
+        Per content type and chunk the heads are moved with one UPDATE and read back with one
+        SELECT, the missing heads are inserted with one statement
+        '''
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        object_ids = dict()
+        for content_type_id, object_id in allocations:
+            object_ids.setdefault(content_type_id, list()).append(object_id)
+        heads = dict()
+        cursor = connection.cursor()
+        for content_type_id, ids in object_ids.items():
+            for start in range(0, len(ids), chunk_size):
+                chunk = ids[start:start+chunk_size]
+                case = 'CASE object_id %s END' % ' '.join(['WHEN %s THEN %s'] * len(chunk))
+                counts, sizes = list(), list()
+                for object_id in chunk:
+                    count, size, created = allocations[(content_type_id, object_id)]
+                    counts.extend([object_id, count])
+                    sizes.extend([object_id, size])
+                cursor.execute('UPDATE %s SET revision = revision + %s, pending_bytes = pending_bytes + %s '
+                               'WHERE content_type_id = %%s AND object_id IN (%s)' % 
+                               (table, case, case, ', '.join(['%s'] * len(chunk))),
+                               counts + sizes + [content_type_id] + chunk)
+                #a batch of new objects has no heads to read back
+                if cursor.rowcount:
+                    for head in self.get_query_set().filter(content_type=content_type_id, object_id__in=chunk):
+                        heads[(content_type_id, head.object_id)] = head
+                missing = [object_id for object_id in chunk if (content_type_id, object_id) not in heads]
+                if missing:
+                    heads.update(self.insert_heads(content_type_id, missing, allocations))
+        return heads
+
+    def insert_heads(self, content_type_id, object_ids, allocations):
+        '''
+        Inserts the heads of objects that have none, objects written before heads were
+        introduced are seeded from their latest revision
+        '''
+        seed = [object_id for object_id in object_ids if not allocations[(content_type_id, object_id)][2]]
+        latest = dict()
+        if seed:
+            latest = dict(FullHistory.objects.filter(content_type=content_type_id, object_id__in=seed)
+                          .values_list('object_id').annotate(models.Max('revision')).order_by())
+        heads = dict()
+        for object_id in object_ids:
+            count, size, created = allocations[(content_type_id, object_id)]
+            last = latest.get(object_id)
+            if last is None:
+                last = -1
+            heads[(content_type_id, object_id)] = self.model(content_type_id=content_type_id,
+                                                             object_id=object_id,
+                                                             revision=last + count,
+                                                             pending_bytes=size)
+        qn = connection.ops.quote_name
+        sid = transaction.savepoint()
+        try:
+            connection.cursor().executemany(
+                'INSERT INTO %s (content_type_id, object_id, revision, checkpoint, pending_bytes) '
+                'VALUES (%%s, %%s, %%s, 0, %%s)' % qn(self.model._meta.db_table),
+                [(content_type_id, head.object_id, head.revision, head.pending_bytes) 
+                 for head in heads.values()])
+        except IntegrityError:
+            #another writer created some of them first, take them one at a time
+            transaction.savepoint_rollback(sid)
+            for object_id in object_ids:
+                count, size, created = allocations[(content_type_id, object_id)]
+                heads[(content_type_id, object_id)] = self.allocate(content_type_id, object_id, 
+                                                                    count, size, created)
+            return heads
+        transaction.savepoint_commit(sid)
+        return heads
+
+    def rebuild(self, chunk_size=500):
+        '''
+        Brings the heads in line with the latest revision recorded for each object
+        The objects of each content type are walked in chunks with rebuild_objects,
+        each chunk is committed unless a transaction is managed
+        Returns the number of heads that were created or moved
+        '''
+        changed = 0
+        histories = FullHistory.objects.order_by()
+        content_types = list(histories.values_list('content_type', flat=True).distinct())
+        for content_type_id in content_types:
+            last = None
+            while True:
+                object_ids = histories.filter(content_type=content_type_id)
+                if last is not None:
+                    object_ids = object_ids.filter(object_id__gt=last)
+                object_ids = list(object_ids.order_by('object_id').values_list('object_id', flat=True)
+                                  .distinct()[:chunk_size])
+                if not object_ids:
+                    break
+                changed += self.rebuild_objects(content_type_id, object_ids)
+                transaction.commit_unless_managed()
+                last = object_ids[-1]
+        return changed
+
+    def rebuild_objects(self, content_type_id, object_ids):
+        '''
+        Same as rebuild for some objects of one content type, with one statement that moves
+        the existing heads and one that inserts the missing ones
+        '''
+        if not object_ids:
+            return 0
+        qn = connection.ops.quote_name
+        heads = qn(self.model._meta.db_table)
+        histories = qn(FullHistory._meta.db_table)
+        latest = ('SELECT MAX(h.revision) FROM %s h WHERE h.content_type_id = %s.content_type_id '
+                  'AND h.object_id = %s.object_id' % (histories, heads, heads))
+        placeholders = ', '.join(['%s'] * len(object_ids))
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET revision = (%s) WHERE content_type_id = %%s AND object_id IN (%s) '
+                       'AND revision < (%s)' % (heads, latest, placeholders, latest),
+                       [content_type_id] + list(object_ids))
+        changed = cursor.rowcount
+        cursor.execute('INSERT INTO %s (content_type_id, object_id, revision, checkpoint, pending_bytes) '
+                       'SELECT content_type_id, object_id, MAX(revision), 0, 0 FROM %s '
+                       'WHERE content_type_id = %%s AND object_id IN (%s) AND NOT EXISTS '
+                       '(SELECT 1 FROM %s WHERE %s.content_type_id = %s.content_type_id '
+                       'AND %s.object_id = %s.object_id) '
+                       'GROUP BY content_type_id, object_id' % (heads, histories, placeholders, heads,
+                                                                heads, histories, heads, histories),
+                       [content_type_id] + list(object_ids))
+        return changed + cursor.rowcount
+
+class HistoryHead(models.Model):
+    '''
+    Tracks the latest revision handed out for each object
+    '''
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.CharField(max_length=255)
+    revision = models.IntegerField()
+    checkpoint = models.IntegerField(default=0)
+    pending_bytes = models.PositiveIntegerField(default=0)
+
+    objects = HistoryHeadManager()
+
+    def checkpoint_due(self):
+        '''
+        Returns True if enough revisions or delta bytes have accumulated
+        since the last checkpoint
+        '''
+        revisions = getattr(settings, 'FULLHISTORY_CHECKPOINT_REVISIONS', 100)
+        size = getattr(settings, 'FULLHISTORY_CHECKPOINT_BYTES', 65536)
+        if revisions and self.revision - self.checkpoint >= revisions:
+            return True
+        return bool(size and self.pending_bytes >= size)
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.content_type_id, 
+                              self.object_id, 
+                              self.revision)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+
+class HistoryCheckpointManager(models.Manager):
+    def nearest(self, content_type, object_id, version=None):
+        '''
+        Returns the latest checkpoint at or below version, or None
+        '''
+        checkpoints = self.get_query_set().filter(content_type=content_type, 
+                                                  object_id=object_id)
+        if version is not None:
+            checkpoints = checkpoints.filter(revision__lte=version)
+        checkpoints = list(checkpoints.order_by('-revision')[:1])
+        if checkpoints:
+            return checkpoints[0]
+        return None
+
+    def record(self, history):
+        '''
+        Stores the full state of the object as of the given history entry
+        '''
+        data = FullHistory.objects.reconstruct(history.content_type_id, 
+                                               history.object_id, 
+                                               history.revision, 
+                                               audit=False)
+        checkpoint = self.create(content_type_id=history.content_type_id,
+                                 object_id=history.object_id,
+                                 revision=history.revision,
+                                 data=data)
+        HistoryHead.objects.filter(content_type=history.content_type_id, 
+                                   object_id=history.object_id).update(checkpoint=history.revision, 
+                                                                       pending_bytes=0)
+        return checkpoint
+
+class HistoryCheckpoint(models.Model):
+    '''
+    A full snapshot of an object at a revision, used as a starting point for reconstruction
+    '''
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.CharField(max_length=255)
+    revision = models.PositiveIntegerField()
+    _data = models.TextField(db_column='data')
+
+    objects = HistoryCheckpointManager()
+
+    def set_data(self, val):
+        self._data = encoders.encode(val)
+
+    def get_data(self):
+        return encoders.decode(self._data)
+
+    data = property(get_data, set_data)
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.content_type_id, 
+                              self.object_id, 
+                              self.revision)
+
+    class Meta:
+        get_latest_by = "revision"
+        unique_together = (('revision', 'content_type', 'object_id'),)
+
 ACTIONS = (('C', 'Create'), ('U', 'Update'), ('D', 'Delete'))
 
 class FullHistory(models.Model):
@@ -111,9 +808,11 @@ class FullHistory(models.Model):
 
     content_object = generic.GenericForeignKey()
     
-    action_time = models.DateTimeField(auto_now_add=True)
+    action_time = models.DateTimeField(auto_now_add=True, db_index=True)
     _data = models.TextField(db_column='data')
     request = models.ForeignKey(Request, null=True, blank=True)
+    #copied from the request so user feeds do not need a join
+    user_pk = models.PositiveIntegerField(null=True, blank=True, editable=False)
     site = models.ForeignKey(Site, default=Site.objects.get_current)
     action = models.CharField(max_length=1, choices=ACTIONS)
     info = models.TextField()
@@ -121,10 +820,18 @@ class FullHistory(models.Model):
     objects = FullHistoryManager()
 
     def set_data(self, val):
-        self._data = ENCODER.encode(val)
+        self._data = encoders.encode(val)
+        self._data_cache = None
 
     def get_data(self):
-        return json.loads(self._data)
+        '''
+        Returns the decoded data, the result is cached until the data is set again
+        Call set_data after modifying the returned value
+        '''
+        cache = self.__dict__.get('_data_cache')
+        if cache is None or cache[0] is not self._data:
+            cache = self._data_cache = (self._data, encoders.decode(self._data))
+        return cache[1]
 
     data = property(get_data, set_data)
 
@@ -136,6 +843,8 @@ class FullHistory(models.Model):
         Returns the user entry responsible for this change
         May return User.DoesNotExist if the user was deleted
         '''
+        if '_user_cache' in self.__dict__:
+            return self._user_cache
         if self.request is None:
             return None
         return self.request.user()
@@ -187,12 +896,40 @@ class FullHistory(models.Model):
         return FullHistory.objects.none()
 
     def save(self, *args, **kwargs):
+        return in_transaction(self.save_revision, *args, **kwargs)
+
+    def save_revision(self, *args, **kwargs):
+        head = None
         if not self.pk:
-            self.revision = len(FullHistory.objects.filter(content_type=self.content_type, 
-                                                           object_id=self.object_id))
+            head = HistoryHead.objects.allocate(self.content_type_id, 
+                                                self.object_id, 
+                                                size=len(self._data),
+                                                created=self.action == 'C')
+            self.revision = head.revision
+        else:
+            #the snapshot at this revision no longer matches the adjusted data
+            HistoryCheckpoint.objects.filter(content_type=self.content_type_id, 
+                                             object_id=self.object_id,
+                                             revision=self.revision).delete()
         if not self.info:
             self.info = self.create_info()
-        return super(FullHistory, self).save(*args, **kwargs)
+        self.save_request()
+        ret = super(FullHistory, self).save(*args, **kwargs)
+        if head is not None and head.checkpoint_due():
+            HistoryCheckpoint.objects.record(self)
+        return ret
+
+    def save_request(self):
+        '''
+        Saves the request of this history if it was deferred until the first change
+        and copies the user of the request
+        '''
+        if self.request_id is None and self.request is not None:
+            if self.request.pk is None:
+                self.request.save()
+            self.request_id = self.request.pk
+        if self.user_pk is None and self.request_id is not None:
+            self.user_pk = self.request.user_pk
 
     def __unicode__(self):
         return u'%s %s %s' % (self.content_type, 
@@ -206,6 +943,34 @@ class FullHistory(models.Model):
         get_latest_by = "revision"
         unique_together = (('revision', 'content_type', 'object_id'),)
 
+def decode_histories(histories):
+    '''
+    Decodes the data of a page of histories in one batched pass
+    Returns the histories as a list with their decoded data cached
+    '''
+    histories = list(histories)
+    texts = [history._data for history in histories]
+    for history, text, value in zip(histories, texts, encoders.decode_many(texts)):
+        history._data_cache = (text, value)
+    return histories
+
+def load_users(histories):
+    '''
+    Loads the users of a page of histories in one query
+    Returns the histories as a list, user() returns None for users that were deleted
+    '''
+    histories = list(histories)
+    user_pks = dict()
+    for history in histories:
+        user_pk = history.user_pk
+        if user_pk is None and history.request_id is not None:
+            user_pk = history.request.user_pk
+        user_pks[history] = user_pk
+    users = User.objects.in_bulk([pk for pk in user_pks.values() if pk is not None])
+    for history in histories:
+        history._user_cache = users.get(user_pks[history])
+    return histories
+
 class HistoryField(generic.GenericRelation):
     def __init__(self, **kwargs):
         return super(HistoryField, self).__init__(FullHistory, **kwargs)
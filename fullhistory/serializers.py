@@ -1,6 +1,208 @@
+import re
+
 from django.core.serializers.python import Serializer as BaseSerializer, Deserializer
-from django.utils.encoding import smart_unicode
+from django.db import connection
+from django.db.models import Field, FileField, TextField
+from django.utils.encoding import smart_unicode, is_protected_type
+from django.utils.hashcompat import sha_constructor
 
 class Serializer(BaseSerializer):
     def handle_fk_field(self, obj, field):
         self._current[field.name] = smart_unicode(field._get_val_from_obj(obj), strings_only=True)
+
+def to_unicode(value):
+    if is_protected_type(value):
+        return value
+    return smart_unicode(value)
+
+def file_to_unicode(value):
+    return smart_unicode(getattr(value, 'name', value) or u'')
+
+LARGE_FIELD_POLICIES = ('full', 'hash', 'skip')
+HASHED_RE = re.compile(r'^sha1:[0-9a-f]{40}:\d+$')
+
+def hash_value(value):
+    '''
+    Returns the stored form of a hashed field, the sha1 and length of its text
+    '''
+    if value is None:
+        return None
+    value = smart_unicode(value)
+    return u'sha1:%s:%s' % (sha_constructor(value.encode('utf-8')).hexdigest(), len(value))
+
+def is_hashed(value):
+    return isinstance(value, basestring) and HASHED_RE.match(value) is not None
+
+def values_match(first, second):
+    '''
+    Compares two recorded values, a hashed value matches the text it was made from
+    so histories recorded under different large field policies still line up
+    '''
+    if is_hashed(first) and not is_hashed(second) and second is not None:
+        second = hash_value(second)
+    elif is_hashed(second) and not is_hashed(first) and first is not None:
+        first = hash_value(first)
+    return first == second
+
+class ValueHolder(object):
+    pass
+
+MISSING = object()
+
+class FieldExtractor(object):
+    '''
+    Precomputed per model replacement for Serializer
+    Returns the same dictionary of field values without the generic serializer machinery
+    ``fields`` and ``exclude`` limit the fields that are extracted, ``large_field_policy``
+    maps field names to 'full', 'hash' or 'skip', a single policy applies to every TextField
+    '''
+    def __init__(self, model, fields=None, exclude=None, large_field_policy=None):
+        opts = model._meta
+        self.pk_name = opts.pk.name
+        self.pk_attname = opts.pk.attname
+        self.fields = list()
+        self.hashed = set()
+        self.large_field_policy = large_field_policy
+        if isinstance(large_field_policy, basestring):
+            policies = [large_field_policy]
+        else:
+            policies = (large_field_policy or {}).values()
+        for policy in policies:
+            if policy not in LARGE_FIELD_POLICIES:
+                raise ValueError('Unknown large field policy %s, use full, hash or skip' % policy)
+        for field in opts.local_fields:
+            if field.primary_key:
+                self.fields.append((field.name, field.attname, self.get_converter(field)))
+                continue
+            policy = self.get_policy(field, fields, exclude)
+            if not field.serialize or policy == 'skip':
+                continue
+            convert = self.get_converter(field)
+            if policy == 'hash':
+                convert = self.get_hasher(convert)
+                self.hashed.add(field.name)
+            self.fields.append((field.name, field.attname, convert))
+        self.many_to_many = [field.name for field in opts.many_to_many 
+                             if field.serialize and field.creates_table and
+                             self.get_policy(field, fields, exclude) != 'skip']
+        self.many_to_many_sql = dict()
+
+    def get_policy(self, field, fields, exclude):
+        '''
+        Returns how a field is stored, excluded fields are skipped
+        '''
+        if (fields is not None and field.name not in fields) or field.name in (exclude or ()):
+            return 'skip'
+        policy = self.large_field_policy
+        if policy is None:
+            return 'full'
+        if isinstance(policy, basestring):
+            if isinstance(field, TextField):
+                return policy
+            return 'full'
+        return policy.get(field.name, 'full')
+
+    def get_hasher(self, convert):
+        def hasher(value):
+            return hash_value(convert(value))
+        return hasher
+
+    def get_converter(self, field):
+        '''
+        Returns a function that turns a raw attribute value into its serialized form
+        '''
+        if isinstance(field, FileField):
+            return file_to_unicode
+        if field.rel is not None or type(field).value_to_string == Field.value_to_string:
+            return to_unicode
+        def convert(value):
+            if is_protected_type(value):
+                return value
+            holder = ValueHolder()
+            setattr(holder, field.attname, value)
+            return field.value_to_string(holder)
+        return convert
+
+    def extract(self, obj, many_to_many=True):
+        data = dict([(name, convert(getattr(obj, attname))) 
+                     for name, attname, convert in self.fields])
+        if many_to_many:
+            for name in self.many_to_many:
+                data[name] = self.get_related_pks(obj, name)
+        data[self.pk_name] = to_unicode(getattr(obj, self.pk_attname))
+        return data
+
+    def changed_fields(self, obj, raw):
+        '''
+        Returns the (name, attname, convert) of fields whose raw value was replaced since
+        ``raw`` was copied from the object's __dict__, this also notices values that were
+        written to __dict__ directly
+        '''
+        current = obj.__dict__
+        changed = [field for field in self.fields 
+                   if current.get(field[1], MISSING) is not raw.get(field[1], MISSING)]
+        if current.get(self.pk_attname, MISSING) is not raw.get(self.pk_attname, MISSING):
+            changed.append((self.pk_name, self.pk_attname, to_unicode))
+        return changed
+
+    def get_related_pks(self, obj, name):
+        '''
+        Returns the primary keys of the objects in a many to many relation
+        The query is compiled once per relation and reused with the object's primary key
+        '''
+        pk = getattr(obj, self.pk_attname)
+        sql = self.many_to_many_sql.get(name)
+        if sql is None or pk is None:
+            queryset = getattr(obj, name).values_list('pk', flat=True)
+            sql, params = queryset.query.as_sql()
+            if list(params) != [pk]:
+                return [to_unicode(related) for related in queryset]
+            self.many_to_many_sql[name] = sql
+        cursor = connection.cursor()
+        cursor.execute(sql, [pk])
+        return [to_unicode(row[0]) for row in cursor.fetchall()]
+
+    def get_related_pks_many(self, model, name, pks):
+        '''
+        Returns a dictionary of the primary keys related to each of ``pks`` in a many
+        to many relation, read with one query on the relation's table
+        '''
+        field = model._meta.get_field(name)
+        qn = connection.ops.quote_name
+        related = dict([(pk, list()) for pk in pks])
+        if not pks:
+            return related
+        sql = 'SELECT %s, %s FROM %s WHERE %s IN (%s)' % (qn(field.m2m_column_name()),
+                                                          qn(field.m2m_reverse_name()),
+                                                          qn(field.m2m_db_table()),
+                                                          qn(field.m2m_column_name()),
+                                                          ', '.join(['%s'] * len(pks)))
+        cursor = connection.cursor()
+        cursor.execute(sql, list(pks))
+        for pk, related_pk in cursor.fetchall():
+            related[pk].append(to_unicode(related_pk))
+        return related
+
+    def read_rows(self, queryset):
+        '''
+        Returns instances holding the values of the extracted fields
+        They are made without __init__ so post_init and its snapshot are skipped
+        '''
+        model = queryset.model
+        names = [name for name, attname, convert in self.fields]
+        attnames = [attname for name, attname, convert in self.fields]
+        for row in queryset.values_list(*names).iterator():
+            obj = model.__new__(model)
+            obj.__dict__.update(zip(attnames, row))
+            yield obj
+
+EXTRACTORS = dict()
+
+def get_extractor(model):
+    '''
+    Returns the field extractor of a model, building it on first use
+    '''
+    extractor = EXTRACTORS.get(model)
+    if extractor is None:
+        extractor = EXTRACTORS[model] = FieldExtractor(model)
+    return extractor
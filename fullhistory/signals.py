@@ -2,4 +2,4 @@ from django import dispatch
 
 post_create = dispatch.Signal()
 post_adjust = dispatch.Signal()
-
+stats_collected = dispatch.Signal()
@@ -0,0 +1,5 @@
+-- composite indexes for the per user feed and time range scans of a model
+CREATE INDEX fullhistory_fullhistory_user_time ON fullhistory_fullhistory (user_pk, action_time, id);
+CREATE INDEX fullhistory_fullhistory_type_time ON fullhistory_fullhistory (content_type_id, action_time);
+-- revision lookups of one object, the unique index starts with revision and cannot serve them
+CREATE INDEX fullhistory_fullhistory_object ON fullhistory_fullhistory (content_type_id, object_id, revision);
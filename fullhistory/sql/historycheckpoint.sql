@@ -0,0 +1,2 @@
+-- nearest checkpoint of one object, the unique index starts with revision and cannot serve it
+CREATE INDEX fullhistory_historycheckpoint_object ON fullhistory_historycheckpoint (content_type_id, object_id, revision);
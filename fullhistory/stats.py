@@ -0,0 +1,173 @@
+'''
+Timings and counters of the history work done per model, enabled with FULLHISTORY_STATS
+The hooks are only installed on handlers while stats are enabled, disabled handlers run untouched
+'''
+import logging
+import threading
+try:
+    from threading import local
+except ImportError:
+    from django.utils._threading_local import local
+import time
+
+from django.conf import settings
+
+from signals import stats_collected
+
+logger = logging.getLogger('fullhistory')
+
+TIMED_METHODS = ('prepare_initial', 'get_all_data', 'get_difference', 'create_history', 'adjust_history')
+#durations kept per model and method for the percentiles
+SAMPLE_SIZE = 1000
+
+class MethodStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.samples = list()
+
+    def add(self, duration):
+        if len(self.samples) < SAMPLE_SIZE:
+            self.samples.append(duration)
+        else:
+            self.samples[self.calls % SAMPLE_SIZE] = duration
+        self.calls += 1
+        self.time += duration
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    def summary(self):
+        return {'calls': self.calls,
+                'time': self.time,
+                'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95),
+                'p99': self.percentile(0.99)}
+
+class Stats(object):
+    '''
+    Process wide counters, keyed by app_label.model
+    Times are inclusive, create_history contains the get_difference it calls
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.methods = dict()
+            self.rows = dict()
+            self.bytes = dict()
+        finally:
+            self.lock.release()
+
+    def add_call(self, model, method, duration):
+        self.lock.acquire()
+        try:
+            key = (model, method)
+            if key not in self.methods:
+                self.methods[key] = MethodStats()
+            self.methods[key].add(duration)
+        finally:
+            self.lock.release()
+
+    def add_rows(self, model, rows, size):
+        self.lock.acquire()
+        try:
+            self.rows[model] = self.rows.get(model, 0) + rows
+            self.bytes[model] = self.bytes.get(model, 0) + size
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        '''
+        Returns {model: {method: {calls, time, p50, p95, p99}, 'rows': n, 'bytes': n}}
+        '''
+        self.lock.acquire()
+        try:
+            ret = dict()
+            for (model, method), method_stats in self.methods.items():
+                ret.setdefault(model, {'rows': 0, 'bytes': 0})[method] = method_stats.summary()
+            for model, rows in self.rows.items():
+                ret.setdefault(model, dict()).update({'rows': rows, 'bytes': self.bytes[model]})
+            return ret
+        finally:
+            self.lock.release()
+
+STATS = Stats()
+
+class RequestStats(local):
+    '''
+    What the current request spent on histories, only the outermost hook adds time
+    '''
+    def __init__(self):
+        self.summary = None
+        self.depth = 0
+
+LOCAL = RequestStats()
+
+def enabled():
+    return getattr(settings, 'FULLHISTORY_STATS', False)
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+def timed(method, func):
+    def _timed(entry, *args, **kwargs):
+        LOCAL.depth += 1
+        start = time.time()
+        try:
+            result = func(entry, *args, **kwargs)
+        finally:
+            duration = time.time() - start
+            LOCAL.depth -= 1
+            label = model_label(type(entry))
+            STATS.add_call(label, method, duration)
+            summary = LOCAL.summary
+            if summary is not None and LOCAL.depth == 0:
+                summary['time'] += duration
+        if method in ('create_history', 'adjust_history') and result is not None:
+            if method == 'adjust_history':
+                #the row was counted when it was created, only its growth is added
+                size = result._size_change
+            else:
+                size = len(result._data or '')
+            STATS.add_rows(label, int(method == 'create_history'), size)
+            if summary is not None:
+                summary['rows'] += int(method == 'create_history')
+                summary['bytes'] += size
+        return result
+    _timed.fullhistory_timed = True
+    return _timed
+
+def install(handler):
+    '''
+    Wraps the timed methods of a handler
+    '''
+    for method in TIMED_METHODS:
+        func = getattr(handler, method)
+        if not getattr(func, 'fullhistory_timed', False):
+            setattr(handler, method, timed(method, func))
+
+def uninstall(handler):
+    for method in TIMED_METHODS:
+        handler.__dict__.pop(method, None)
+
+def start_request():
+    LOCAL.summary = {'rows': 0, 'bytes': 0, 'time': 0.0}
+
+def format_summary(summary):
+    return 'histories=%(rows)s bytes=%(bytes)s time=%(time).6f' % summary
+
+def end_request(request=None):
+    '''
+    Returns what the current request spent on histories and sends stats_collected
+    '''
+    summary, LOCAL.summary = LOCAL.summary, None
+    if summary is not None:
+        stats_collected.send(sender=Stats, request=request, summary=summary)
+    return summary
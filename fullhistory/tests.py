@@ -1,3 +1,4 @@
+from __future__ import with_statement
 import unittest
 
 from django.test import TestCase
@@ -8,6 +9,7 @@ from django.contrib import admin
 
 from models import *
 from admin import *
+from managers import HistoryManager
 import fullhistory
 
 import django
@@ -30,6 +32,8 @@ class Test3Model(models.Model):
     test2_fk = models.ForeignKey(Test2Model, null=True)
     test1_m2m = models.ManyToManyField(Test1Model)
 
+    objects = HistoryManager()
+
 class Test4Model(Test2Model):
     field2 = models.FloatField(default=0.0)
 
@@ -216,3 +220,970 @@ class FullHistoryTest(TestCase):
         response = self.client.get('%s%s/history/version/256/' % (base, t3.pk))
         self.assertEqual(404, response.status_code)
 
+
+    def test_revision_heads(self):
+        fullhistory.end_session()
+        t1 = Test1Model(field1="head")
+        t1.save()
+        t1.field1 = "head2"
+        t1.save()
+        ct = ContentType.objects.get_for_model(t1)
+        self.assertEqual(1, HistoryHead.objects.get(content_type=ct, object_id=t1.pk).revision)
+        #heads missing for old data are seeded from the existing rows
+        HistoryHead.objects.filter(content_type=ct, object_id=t1.pk).delete()
+        t1.field1 = "head3"
+        t1.save()
+        self.assertEqual(2, FullHistory.objects.actions_for_object(t1).reverse()[0].revision)
+        self.assertEqual(2, HistoryHead.objects.get(content_type=ct, object_id=t1.pk).revision)
+
+    def test_backfill_heads(self):
+        from django.core.management import call_command
+        fullhistory.end_session()
+        t1 = Test1Model(field1="backfill")
+        t1.save()
+        t1.field1 = "backfill2"
+        t1.save()
+        HistoryHead.objects.all().delete()
+        call_command('backfill_fullhistory', verbosity=0)
+        ct = ContentType.objects.get_for_model(t1)
+        self.assertEqual(1, HistoryHead.objects.get(content_type=ct, object_id=t1.pk).revision)
+        #objects are walked in chunks, heads already in line are left alone
+        others = [Test1Model.objects.create(field1="backfill%s" % i) for i in range(3)]
+        HistoryHead.objects.filter(content_type=ct, object_id__in=[t1.pk] + [t.pk for t in others]).delete()
+        self.assertEqual(4, HistoryHead.objects.rebuild(chunk_size=1))
+        self.assertEqual(0, HistoryHead.objects.rebuild(chunk_size=2))
+        self.assertEqual(1, HistoryHead.objects.get(content_type=ct, object_id=t1.pk).revision)
+        for other in others:
+            self.assertEqual(0, HistoryHead.objects.get(content_type=ct, object_id=other.pk).revision)
+
+    def test_checkpoints(self):
+        from django.conf import settings
+        old_revisions = getattr(settings, 'FULLHISTORY_CHECKPOINT_REVISIONS', 100)
+        settings.FULLHISTORY_CHECKPOINT_REVISIONS = 3
+        try:
+            fullhistory.end_session()
+            t3 = Test3Model(field1="cp0", field2=0)
+            t3.save()
+            for i in range(1, 8):
+                t3.field2 = i
+                t3.save()
+        finally:
+            settings.FULLHISTORY_CHECKPOINT_REVISIONS = old_revisions
+        ct = ContentType.objects.get_for_model(t3)
+        checkpoints = HistoryCheckpoint.objects.filter(content_type=ct, object_id=t3.pk)
+        self.assertEqual([3, 6], [cp.revision for cp in checkpoints.order_by('revision')])
+        for version in range(8):
+            self.assertEqual(version, FullHistory.objects.get_version(t3, version=version)['field2'])
+        FullHistory.objects.audit(t3)
+        #adjusting a checkpointed revision drops the stale snapshot
+        history = FullHistory.objects.actions_for_object(t3).get(revision=6)
+        history.save()
+        self.assertEqual([3], [cp.revision for cp in checkpoints.order_by('revision')])
+        self.assertEqual(7, FullHistory.objects.get_version(t3)['field2'])
+
+    def test_buffered_histories(self):
+        from signals import post_create
+        fullhistory.end_session()
+        created = list()
+        def record_created(fullhistory, **kwargs):
+            created.append(fullhistory.pk)
+        post_create.connect(record_created)
+        try:
+            def make_objects():
+                t1 = Test1Model(field1="buf")
+                t1.save()
+                t1.field1 = "buf2"
+                t1.save()
+                t3 = Test3Model(field1="buf3")
+                t3.save()
+                t3.test1_m2m.add(t1)
+                fullhistory.adjust_history(t3)
+                self.assertEqual(0, len(FullHistory.objects.actions_for_object(t1)))
+                return t1, t3
+            t1, t3 = fullhistory.buffer_histories(make_objects)()
+        finally:
+            post_create.disconnect(record_created)
+        self.assertEqual([0, 1], [h.revision for h in FullHistory.objects.actions_for_object(t1)])
+        self.assertEqual(3, len(created))
+        self.assertTrue(None not in created)
+        history = FullHistory.objects.actions_for_object(t3).get()
+        self.assertEqual([t1.pk], history.data['test1_m2m'][0])
+        FullHistory.objects.audit(t1)
+
+        def fail():
+            Test1Model(field1="rolledback").save()
+            raise ValueError()
+        count = FullHistory.objects.count()
+        self.assertRaises(ValueError, fullhistory.buffer_histories(fail))
+        self.assertEqual(count, FullHistory.objects.count())
+
+        def flush_and_fail():
+            Test1Model(field1="flushed").save()
+            fullhistory.get_active_histories()
+            Test1Model(field1="rolledback").save()
+            raise ValueError()
+        self.assertRaises(ValueError, fullhistory.buffer_histories(flush_and_fail))
+        self.assertEqual(count + 1, FullHistory.objects.count())
+
+        #autocommitted changes keep their histories when the function raises
+        rolling_back = fullhistory.rolling_back
+        fullhistory.rolling_back = lambda: False
+        try:
+            self.assertRaises(ValueError, fullhistory.buffer_histories(fail))
+        finally:
+            fullhistory.rolling_back = rolling_back
+        self.assertEqual(count + 2, FullHistory.objects.count())
+
+    def test_batched_heads(self):
+        from django.db import connection
+        fullhistory.end_session()
+        objs = Test3Model.objects.bulk_create([Test3Model(field1="head", field2=i) for i in range(3)])
+        ct = ContentType.objects.get_for_model(Test3Model)
+        #written before heads existed, seeded from the latest revision
+        HistoryHead.objects.filter(content_type=ct, object_id=objs[0].pk).delete()
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            with fullhistory.buffered():
+                for obj in objs:
+                    obj.field2 += 10
+                    obj.save()
+                    obj.field2 += 10
+                    obj.save()
+            heads = [query['sql'] for query in connection.queries if 'historyhead' in query['sql']]
+        finally:
+            settings.DEBUG = False
+        self.assertEqual(3, len(heads))
+        self.assertTrue(heads[0].startswith('UPDATE') and heads[1].startswith('SELECT') and 'INSERT' in heads[2])
+        for obj in objs:
+            self.assertEqual([0, 1, 2], list(FullHistory.objects.actions_for_object(obj)
+                                             .values_list('revision', flat=True)))
+            self.assertEqual(2, HistoryHead.objects.get(content_type=ct, object_id=obj.pk).revision)
+            FullHistory.objects.audit(obj)
+
+    def test_background_writer(self):
+        from writer import HistoryWriter, DROP, SYNC
+        written = list()
+        def write(batch):
+            written.append(list(batch))
+        dropping = HistoryWriter(write, maxsize=2, overflow=DROP)
+        dropping.put([1, 2, 3])
+        self.assertEqual(1, dropping.dropped)
+        dropping.start()
+        dropping.flush()
+        dropping.shutdown()
+        self.assertEqual([[1, 2]], written)
+
+        del written[:]
+        fallback = HistoryWriter(write, maxsize=2, batch_size=1, overflow=SYNC)
+        fallback.put([1, 2, 3])
+        self.assertEqual([[1, 2, 3]], written)
+
+        #revisions are allocated in the order the changes were made
+        fullhistory.end_session()
+        with fullhistory.buffered() as session:
+            t3 = Test3Model(field1="sync", field2=0)
+            t3.save()
+            for i in range(1, 4):
+                t3.field2 = i
+                t3.save()
+            pending, session.pending = session.pending, list()
+        #every other history overflows, so all of them are written in this thread
+        fallback = HistoryWriter(fullhistory.write_histories, maxsize=1, overflow=SYNC)
+        fallback.put(pending)
+        self.assertTrue(fallback.queue.empty())
+        histories = FullHistory.objects.actions_for_object(t3).order_by('revision')
+        self.assertEqual([(0, 'C', 0), (1, 'U', 1), (2, 'U', 2), (3, 'U', 3)],
+                         [(h.revision, h.action, h.data['field2'][-1]) for h in histories])
+        FullHistory.objects.audit(t3)
+
+    def test_background_mode(self):
+        from django.conf import settings
+        import writer
+        queued = list()
+        old_writer, writer.WRITER = writer.WRITER, writer.HistoryWriter(queued.extend)
+        settings.FULLHISTORY_WRITER = 'background'
+        try:
+            fullhistory.end_session()
+            with fullhistory.history_session():
+                t3 = Test3Model(field1="bg")
+                t3.save()
+                t1 = Test1Model(field1="bg")
+                t1.save()
+                t3.test1_m2m.add(t1)
+                history = fullhistory.adjust_history(t3)
+                self.assertEqual(None, history.pk)
+                self.assertEqual([], queued)
+            self.assertEqual(0, len(FullHistory.objects.actions_for_object(t3)))
+            #outside of a request or session nothing would hand a buffer over, histories go right away
+            fullhistory.STATE.stack = []
+            Test1Model(field1="no session").save()
+            writer.WRITER.start()
+            writer.WRITER.shutdown()
+        finally:
+            writer.WRITER = old_writer
+            del settings.FULLHISTORY_WRITER
+            fullhistory.end_session()
+        self.assertEqual(3, len(queued))
+        self.assertEqual("no session", queued[-1][1].field1)
+        fullhistory.write_histories(queued)
+        self.assertEqual([t1.pk], FullHistory.objects.actions_for_object(t3).get().data['test1_m2m'][0])
+
+        #buffers still open at exit are written
+        fullhistory.STATE.stack = []
+        fullhistory.start_buffer()
+        t1 = Test1Model(field1="at exit")
+        t1.save()
+        self.assertEqual(0, len(FullHistory.objects.actions_for_object(t1)))
+        fullhistory.flush_open_sessions()
+        self.assertEqual(1, len(FullHistory.objects.actions_for_object(t1)))
+        fullhistory.end_session()
+
+    def test_lazy_initial(self):
+        fullhistory.end_session()
+        t3 = Test3Model(field1="lazy", field2=1)
+        t3.save()
+        handler = fullhistory.REGISTERED_MODELS[Test3Model]
+        handler.lazy_initial = True
+        try:
+            t3 = Test3Model.objects.get(pk=t3.pk)
+        finally:
+            handler.lazy_initial = False
+        self.assertFalse('_fullhistory' in t3.__dict__)
+        t3.field2 = 2
+        t3.save()
+        history = FullHistory.objects.actions_for_object(t3).get(revision=1)
+        self.assertEqual([1, 2], history.data['field2'])
+        self.assertFalse('field1' in history.data)
+        FullHistory.objects.audit(t3)
+
+        #loaded objects are serialized by default so many to many changes can be adjusted
+        t3 = Test3Model.objects.get(pk=t3.pk)
+        self.assertEqual(2, t3.__dict__['_fullhistory']['field2'])
+        t1 = Test1Model(field1="lazy")
+        t1.save()
+        t3.test1_m2m.add(t1)
+        history = fullhistory.adjust_history(t3)
+        self.assertEqual([[], [t1.pk]], history.data['test1_m2m'])
+        FullHistory.objects.audit(t3)
+
+    def test_extractor_matches_serializer(self):
+        from serializers import Serializer, get_extractor
+        fullhistory.end_session()
+        t1 = Test1Model(field1="ext")
+        t1.save()
+        t4 = Test4Model(field1="testup/file.txt", field2=1.5)
+        t4.save()
+        t3 = Test3Model(field1="ext", field2=3, test2_fk=t4)
+        t3.save()
+        t3.test1_m2m.add(t1)
+        for obj in (t1, t3, t4, Test2Model.objects.get(pk=t4.pk), Test2Model(field1=None)):
+            serial = Serializer().serialize([obj])[0]
+            serial['fields'][obj._meta.pk.name] = serial['pk']
+            self.assertEqual(serial['fields'], get_extractor(type(obj)).extract(obj))
+
+    def test_tracked_changes(self):
+        from serializers import get_extractor
+        fullhistory.end_session()
+        handler = fullhistory.REGISTERED_MODELS[Test3Model]
+        extractor = get_extractor(Test3Model)
+        handler.track_changes = True
+        try:
+            t3 = Test3Model(field1="tracked", field2=1)
+            t3.save()
+            t3 = Test3Model.objects.get(pk=t3.pk)
+            t3.field2 = 2
+            t3.save()
+            calls = list()
+            extract = extractor.extract
+            extractor.extract = lambda obj: calls.append(obj) or extract(obj)
+            try:
+                t3.field2 = 3
+                t3.save()
+                #bypasses attribute assignment
+                t3.__dict__['field1'] = 'raw'
+                t3.save()
+                t1 = Test1Model(field1="tracked")
+                t1.save()
+                t3.test1_m2m.add(t1)
+                fullhistory.adjust_history(t3)
+            finally:
+                del extractor.extract
+            self.assertEqual([], calls)
+        finally:
+            handler.track_changes = False
+        histories = FullHistory.objects.actions_for_object(t3)
+        self.assertEqual([2, 3], histories.get(revision=2).data['field2'])
+        self.assertFalse('field1' in histories.get(revision=2).data)
+        self.assertEqual(['tracked', 'raw'], histories.get(revision=3).data['field1'])
+        self.assertEqual([[], [t1.pk]], histories.get(revision=3).data['test1_m2m'])
+        FullHistory.objects.audit(t3)
+
+    def test_codecs(self):
+        from django.core.management import call_command
+        import encoders
+        value = {'field1': [u'a\xe9', u'b'], 'field2': [1]}
+        for name, codec in encoders.CODECS.items():
+            self.assertEqual(value, encoders.decode(codec.encode(value)))
+        self.assertEqual(value, encoders.decode(u'{"field1": ["a\\u00e9", "b"], "field2": [1]}'))
+
+        fullhistory.end_session()
+        t3 = Test3Model(field1="codec", field2=1)
+        t3.save()
+        t3.field2 = 2
+        t3.save()
+        call_command('reencode_fullhistory', codec='zlib', verbosity=0)
+        history = FullHistory.objects.actions_for_object(t3).get(revision=1)
+        self.assertTrue(history._data.startswith(encoders.ZlibCodec.prefix))
+        self.assertEqual([1, 2], history.data['field2'])
+        FullHistory.objects.audit(t3)
+        call_command('reencode_fullhistory', codec='json', verbosity=0)
+        history = FullHistory.objects.actions_for_object(t3).get(revision=1)
+        self.assertTrue(history._data.startswith('{'))
+
+    def test_decoded_data_cache(self):
+        import encoders
+        fullhistory.end_session()
+        t3 = Test3Model(field1="cache", field2=1)
+        t3.save()
+        t3.field2 = 2
+        t3.save()
+        pk = t3.pk
+        t3.delete()
+        histories = FullHistory.objects.actions_for_object(model=Test3Model, pk=pk)
+        decoded = decode_histories(histories)
+        self.assertEqual([h.data for h in histories], [h.data for h in decoded])
+        self.assertEqual(None, decoded[2].data)
+        history = decoded[1]
+        self.assertTrue(history.data is history.data)
+        history.data = {'field2': [1, 3]}
+        self.assertEqual([1, 3], history.data['field2'])
+        history._data = encoders.encode({'field2': [1, 4]}, 'zlib')
+        self.assertEqual([1, 4], history.data['field2'])
+
+    def test_deferred_and_rotated_requests(self):
+        from django.conf import settings
+        fullhistory.end_session()
+        count = Request.objects.count()
+        rq = fullhistory.get_or_create_request()
+        self.assertEqual(None, rq.pk)
+        self.assertEqual(count, Request.objects.count())
+        def make_objects():
+            for i in range(3):
+                Test1Model(field1="rq%s" % i).save()
+            self.assertEqual(count, Request.objects.count())
+        fullhistory.buffer_histories(make_objects)()
+        self.assertEqual(count + 1, Request.objects.count())
+        self.assertEqual(3, len(fullhistory.get_active_histories()))
+
+        fullhistory.end_session()
+        settings.FULLHISTORY_REQUEST_MAX_CHANGES = 2
+        try:
+            for i in range(3):
+                Test1Model(field1="rot%s" % i).save()
+            self.assertEqual(count + 3, Request.objects.count())
+            #each history counts, not each lookup of the request
+            fullhistory.rotate_request()
+            for i in range(2):
+                fullhistory.get_or_create_request()
+            Test1Model(field1="rot").save()
+            self.assertEqual(count + 4, Request.objects.count())
+            #updates of many rows are split as well
+            pks = [Test3Model.objects.create(field1="rot", field2=i).pk for i in range(3)]
+            fullhistory.rotate_request()
+            Test3Model.objects.filter(pk__in=pks).update(field1="rot2")
+            updates = FullHistory.objects.filter(content_type=ContentType.objects.get_for_model(Test3Model),
+                                                 object_id__in=pks, action='U')
+            self.assertEqual(3, len(updates))
+            self.assertEqual(2, len(set([history.request_id for history in updates])))
+        finally:
+            del settings.FULLHISTORY_REQUEST_MAX_CHANGES
+        count = Request.objects.count()
+        fullhistory.rotate_request()
+        Test1Model(field1="rot").save()
+        self.assertEqual(count + 1, Request.objects.count())
+
+    def test_history_sessions(self):
+        import threading
+        fullhistory.end_session()
+        outer = fullhistory.get_or_create_request()
+        with fullhistory.history_session() as session:
+            fullhistory.start_buffer()
+            inner = fullhistory.get_or_create_request()
+            self.assertFalse(inner is outer)
+            Test1Model(field1="session").save()
+            self.assertEqual(1, len(session.pending))
+        self.assertTrue(fullhistory.get_or_create_request() is outer)
+        self.assertEqual(1, len(FullHistory.objects.filter(request=inner)))
+
+        try:
+            with fullhistory.history_session():
+                fullhistory.start_buffer()
+                Test1Model(field1="dropped").save()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(0, len(FullHistory.objects.filter(_data__contains='dropped')))
+
+        seen = list()
+        def other_thread():
+            seen.append(fullhistory.current_session())
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+        self.assertEqual([None], seen)
+
+    def test_bulk_operations(self):
+        fullhistory.end_session()
+        created = Test3Model.objects.bulk_create([Test3Model(field1="bulk", field2=i) for i in range(3)])
+        pks = [t3.pk for t3 in created]
+        self.assertEqual(3, FullHistory.objects.filter(content_type=ContentType.objects.get_for_model(Test3Model),
+                                                       object_id__in=pks).count())
+        Test3Model.objects.filter(pk__in=pks[:2]).update(field1="bulk2")
+        Test3Model.objects.filter(pk__in=pks[2:]).update(field2=2)
+        for pk in pks[:2]:
+            history = FullHistory.objects.actions_for_object(model=Test3Model, pk=pk).get(revision=1)
+            self.assertEqual(['bulk', 'bulk2'], history.data['field1'])
+            FullHistory.objects.audit(Test3Model.objects.get(pk=pk))
+        self.assertEqual(1, len(FullHistory.objects.actions_for_object(model=Test3Model, pk=pks[2])))
+        #an evaluated queryset still reads the rows as they are before the update
+        queryset = Test3Model.objects.filter(pk=pks[0])
+        list(queryset)
+        t3 = Test3Model.objects.get(pk=pks[0])
+        t3.field1 = "saved"
+        t3.save()
+        queryset.update(field1="bulk3")
+        history = FullHistory.objects.actions_for_object(model=Test3Model, pk=pks[0]).get(revision=3)
+        self.assertEqual(['saved', 'bulk3'], history.data['field1'])
+        FullHistory.objects.audit(Test3Model.objects.get(pk=pks[0]))
+        #the rows are read without post_init, so the statements do not grow with the rows
+        from django.db import connection
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            Test3Model.objects.filter(pk__in=pks).update(field2=5)
+            statements = [query['sql'] for query in connection.queries]
+        finally:
+            settings.DEBUG = False
+        self.assertFalse([sql for sql in statements if 'fullhistory_test1model' in sql])
+        self.assertEqual(1, len([sql for sql in statements if sql.startswith('UPDATE "fullhistory_historyhead"')]))
+        for pk in pks:
+            self.assertEqual(5, FullHistory.objects.actions_for_object(model=Test3Model, pk=pk).reverse()[0].data['field2'][1])
+        Test3Model.objects.filter(pk__in=pks).delete()
+        for pk in pks:
+            self.assertEqual('D', FullHistory.objects.actions_for_object(model=Test3Model, pk=pk).reverse()[0].action)
+
+    def test_as_of(self):
+        import datetime
+        fullhistory.end_session()
+        FullHistory.objects.filter(content_type=ContentType.objects.get_for_model(Test3Model)).delete()
+        t3a = Test3Model(field1="a", field2=1)
+        t3a.save()
+        t3b = Test3Model(field1="b", field2=1)
+        t3b.save()
+        pk_b = t3b.pk
+        then = datetime.datetime.now()
+        t3a.field2 = 2
+        t3a.save()
+        t3b.delete()
+        later = then + datetime.timedelta(hours=1)
+        FullHistory.objects.filter(pk__gt=FullHistory.objects.order_by('-pk')[2].pk).update(action_time=later)
+        states = dict(FullHistory.objects.as_of(Test3Model, then, chunk_size=1))
+        self.assertEqual([t3a.pk, pk_b], sorted(states.keys()))
+        self.assertEqual(1, states[t3a.pk]['field2'])
+        states = dict(FullHistory.objects.as_of(Test3Model, later, instances=True))
+        self.assertEqual([t3a.pk], states.keys())
+        self.assertEqual(2, states[t3a.pk].field2)
+
+    def test_get_versions(self):
+        from django.conf import settings
+        fullhistory.end_session()
+        settings.FULLHISTORY_CHECKPOINT_REVISIONS = 2
+        try:
+            objects = list()
+            for i in range(3):
+                t3 = Test3Model(field1="versions", field2=0)
+                t3.save()
+                for j in range(i * 2):
+                    t3.field2 = j + 1
+                    t3.save()
+                objects.append(t3)
+        finally:
+            del settings.FULLHISTORY_CHECKPOINT_REVISIONS
+        pks = [t3.pk for t3 in objects]
+        for version in (None, 0, 1, 3):
+            versions = FullHistory.objects.get_versions(Test3Model, pks, version=version, chunk_size=2)
+            for t3 in objects:
+                self.assertEqual(FullHistory.objects.get_version(t3, version=version), versions[t3.pk])
+        versions = FullHistory.objects.get_versions(entries=objects)
+        self.assertEqual([0, 2, 4], [versions[pk]['field2'] for pk in pks])
+
+    def test_export_import(self):
+        import os
+        import tempfile
+        from django.core.management import call_command
+        fullhistory.end_session()
+        t3 = Test3Model(field1="export", field2=1)
+        t3.save()
+        t3.field2 = 2
+        t3.save()
+        ct = ContentType.objects.get_for_model(t3)
+        histories = FullHistory.objects.filter(content_type=ct, object_id=t3.pk)
+        expected = [(h.revision, h.action, h.data, h.request.user_name, h.action_time) 
+                    for h in histories.order_by('revision')]
+        fd, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        requests = Request.objects.count()
+        try:
+            call_command('export_fullhistory', output=path, content_types=['fullhistory.test3model'], 
+                         chunk_size=1, verbosity=0)
+            histories.delete()
+            HistoryHead.objects.filter(content_type=ct, object_id=t3.pk).delete()
+            call_command('import_fullhistory', path, chunk_size=1, verbosity=0)
+        finally:
+            os.remove(path)
+        self.assertEqual(expected, [(h.revision, h.action, h.data, h.request.user_name, h.action_time) 
+                                    for h in histories.order_by('revision')])
+        self.assertEqual(requests + 1, Request.objects.count())
+        self.assertEqual(1, HistoryHead.objects.get(content_type=ct, object_id=t3.pk).revision)
+        FullHistory.objects.audit(t3)
+        #heads that are behind are moved, others are left alone
+        HistoryHead.objects.filter(content_type=ct, object_id=t3.pk).update(revision=0)
+        self.assertEqual(1, HistoryHead.objects.rebuild_objects(ct.pk, [unicode(t3.pk)]))
+        self.assertEqual(0, HistoryHead.objects.rebuild_objects(ct.pk, [unicode(t3.pk)]))
+        self.assertEqual(1, HistoryHead.objects.get(content_type=ct, object_id=t3.pk).revision)
+
+        #forgotten requests are written again and imported once
+        from archive import ArchiveWriter, RecentSet
+        from StringIO import StringIO
+        recent = RecentSet(4)
+        for key in range(6):
+            recent.add(key)
+        self.assertEqual([2, 3, 4, 5], sorted(recent.keys))
+        writer = ArchiveWriter(StringIO(), max_requests=0)
+        writer.write_histories(list(histories))
+        writer.write_histories(list(histories))
+        self.assertEqual(2, writer.request_count)
+
+    def test_compact(self):
+        import datetime
+        import os
+        import shutil
+        import tempfile
+        from django.core.management import call_command
+        from archive import open_archive, read_archive
+        fullhistory.end_session()
+        t3 = Test3Model(field1="compact", field2=0)
+        t3.save()
+        for value in range(1, 6):
+            t3.field2 = value
+            t3.save()
+        ct = ContentType.objects.get_for_model(t3)
+        histories = FullHistory.objects.actions_for_object(t3)
+        histories.filter(revision__lte=2).update(action_time=datetime.datetime(2009, 1, 5))
+        histories.filter(revision__in=[3, 4]).update(action_time=datetime.datetime(2009, 2, 5))
+        expected = dict([(version, FullHistory.objects.get_version(t3, version=version)) 
+                         for version in range(6)])
+        archive_dir = tempfile.mkdtemp()
+        settings.FULLHISTORY_RETENTION = {'fullhistory.test3model': {'days': 90, 'snapshots': 'month'}}
+        try:
+            call_command('compact_fullhistory', processes=1, archive_dir=archive_dir, verbosity=0)
+            archives = os.listdir(archive_dir)
+            self.assertEqual(1, len(archives))
+            stream = open_archive(os.path.join(archive_dir, archives[0]))
+            self.assertEqual([0, 1, 3], [row['revision'] for row in read_archive(stream) 
+                                         if row['type'] == 'history'])
+            stream.close()
+        finally:
+            del settings.FULLHISTORY_RETENTION
+            shutil.rmtree(archive_dir)
+        self.assertEqual([2, 4, 5], list(histories.values_list('revision', flat=True)))
+        for version in (2, 4, 5):
+            self.assertEqual(expected[version], FullHistory.objects.get_version(t3, version=version))
+        #nothing is kept before the first snapshot
+        self.assertRaises(FullHistory.DoesNotExist, FullHistory.objects.get_version, t3, version=1)
+        self.assertEqual(expected[5], FullHistory.objects.get_versions(Test3Model, [t3.pk])[t3.pk])
+        self.assertEqual(expected[4], dict(FullHistory.objects.as_of(Test3Model, datetime.datetime(2009, 3, 1)))[t3.pk])
+        self.assertEqual(5, HistoryHead.objects.get(content_type=ct, object_id=t3.pk).revision)
+        FullHistory.objects.audit(t3)
+        t3.field2 = 6
+        t3.save()
+        self.assertEqual(6, FullHistory.objects.audit(t3)['field2'])
+
+    def test_user_actions(self):
+        import datetime
+        class FakeRequest(object):
+            path = '/feed/'
+            user = User.objects.get(username='test')
+        fullhistory.end_session()
+        with fullhistory.history_session(FakeRequest()):
+            entries = [Test3Model.objects.create(field1="feed %s" % index, field2=index) 
+                       for index in range(5)]
+        Test3Model.objects.create(field1="system", field2=0)
+        user = FakeRequest.user
+        feed = FullHistory.objects.user_actions(user)
+        self.assertEqual(5, feed.count())
+        self.assertEqual([user.pk] * 5, [history.request.user_pk for history in feed])
+        #all rows share one timestamp when the clock is coarse, pages must still be stable
+        FullHistory.objects.filter(user_pk=user.pk).update(action_time=datetime.datetime(2009, 6, 1))
+        feed = FullHistory.objects.user_actions(user)
+        pages = list()
+        page = list(feed[:2])
+        while page:
+            pages.extend(page)
+            page = list(FullHistory.objects.user_actions(user, before=page[-1])[:2])
+        self.assertEqual(list(feed), pages)
+        self.assertEqual(sorted([history.pk for history in pages], reverse=True), 
+                         [history.pk for history in pages])
+        self.assertEqual(0, FullHistory.objects.user_actions(user, since=datetime.datetime(2009, 6, 2)).count())
+        self.assertEqual(5, FullHistory.objects.user_actions(user, until=datetime.datetime(2009, 6, 2)).count())
+        FullHistory.objects.filter(user_pk=user.pk).update(user_pk=None)
+        self.assertEqual(5, FullHistory.objects.backfill_users(chunk_size=2))
+        self.assertEqual(5, FullHistory.objects.user_actions(user).count())
+
+    def test_paginated_history_log(self):
+        if not django1_1:
+            return
+        from django.db import connection
+        fullhistory.end_session()
+        settings.FULLHISTORY_ADMIN_PAGE_SIZE = 5
+        base = '/admin/%s/%s/' % (Test3Model._meta.app_label, Test3Model._meta.module_name)
+        def history_log(t3, query=''):
+            settings.DEBUG = True
+            connection.queries = []
+            try:
+                response = self.client.get('%s%s/history/%s' % (base, t3.pk, query))
+                return response, len(connection.queries)
+            finally:
+                settings.DEBUG = False
+        try:
+            short = Test3Model.objects.create(field1="short", field2=0)
+            long = Test3Model.objects.create(field1="long", field2=0)
+            for value in range(1, 23):
+                long.field2 = value
+                long.save()
+            response, short_queries = history_log(short)
+            self.assertEqual([0], [action.revision for action in response.context[0]['action_list']])
+            self.assertFalse(response.context[0]['has_next'])
+            revisions = list()
+            response, long_queries = history_log(long)
+            self.assertEqual(short_queries, long_queries)
+            while True:
+                page = [action.revision for action in response.context[0]['action_list']]
+                self.assertTrue(len(page) <= 5)
+                revisions.extend(page)
+                if not response.context[0]['has_next']:
+                    break
+                response, queries = history_log(long, '?after=%s' % page[-1])
+                self.assertEqual(short_queries, queries)
+            self.assertEqual(range(23), revisions)
+            response, queries = history_log(long, '?before=end')
+            self.assertEqual([18, 19, 20, 21, 22], [action.revision for action in response.context[0]['action_list']])
+            self.assertTrue(response.context[0]['has_previous'])
+            self.assertFalse(response.context[0]['has_next'])
+            response, queries = history_log(long, '?before=3')
+            self.assertEqual([0, 1, 2], [action.revision for action in response.context[0]['action_list']])
+            self.assertFalse(response.context[0]['has_previous'])
+            self.assertEqual(404, self.client.get('%s%s/history/?after=x' % (base, long.pk)).status_code)
+        finally:
+            del settings.FULLHISTORY_ADMIN_PAGE_SIZE
+
+    def test_version_cache(self):
+        import cache
+        from signals import post_adjust
+        fullhistory.end_session()
+        t3 = Test3Model(field1="cached", field2=0)
+        t3.save()
+        t3.field2 = 1
+        t3.save()
+        ct = ContentType.objects.get_for_model(t3)
+        settings.FULLHISTORY_VERSION_CACHE = 'local'
+        try:
+            version_cache = cache.get_version_cache()
+            self.assertEqual(None, cache.get_version(ct, t3.pk, 1))
+            self.assertEqual(1, FullHistory.objects.get_version(t3, version=1, audit=False)['field2'])
+            self.assertEqual(1, cache.get_version(ct, t3.pk, 1)['field2'])
+            #a revision that does not exist yet is not cached
+            FullHistory.objects.get_version(t3, version=2, audit=False)
+            self.assertEqual(None, cache.get_version(ct, t3.pk, 2))
+            #served without replaying
+            FullHistory.objects.filter(content_type=ct, object_id=t3.pk).update(_data='{}')
+            self.assertEqual(1, FullHistory.objects.get_version(t3, version=1, audit=False)['field2'])
+            FullHistory.objects.get_version(t3, version=1, audit=False)['field2'] = 5
+            self.assertEqual(1, cache.get_version(ct, t3.pk, 1)['field2'])
+            #adjusting the revision drops it
+            history = FullHistory.objects.get(content_type=ct, object_id=t3.pk, revision=1)
+            post_adjust.send(sender=Test3Model, fullhistory=history, instance=t3)
+            self.assertEqual(None, cache.get_version(ct, t3.pk, 1))
+
+            local = cache.LocalVersionCache(100)
+            for key in 'abcde':
+                local.set(key, 'x' * 20)
+            local.get('a')
+            local.set('f', 'x' * 20)
+            self.assertEqual('x' * 20, local.get('a'))
+            self.assertEqual(None, local.get('b'))
+            self.assertTrue(local.size <= 75)
+            local.set('g', 'x' * 101)
+            self.assertEqual(None, local.get('g'))
+        finally:
+            del settings.FULLHISTORY_VERSION_CACHE
+            cache.CACHES.clear()
+
+    def test_audit_command(self):
+        import json
+        import os
+        import tempfile
+        from django.core.management import call_command
+        fullhistory.end_session()
+        entries = list()
+        for index in range(4):
+            t3 = Test3Model(field1="audit %s" % index, field2=0)
+            t3.save()
+            t3.field2 = 1
+            t3.save()
+            entries.append(t3)
+        #related objects are compared whatever order they are read in
+        for field1 in ("b", "a"):
+            entries[0].test1_m2m.add(Test1Model.objects.create(field1=field1))
+        fullhistory.adjust_history(entries[0])
+        fullhistory.end_session()
+        ct = ContentType.objects.get_for_model(Test3Model)
+        FullHistory.objects.filter(content_type=ct, object_id=entries[1].pk, 
+                                   revision=1).update(_data='{"field2": [0, 7]}')
+        FullHistory.objects.filter(content_type=ct, object_id=entries[2].pk, 
+                                   revision=1).update(_data='{"field2": [3, 1]}')
+        FullHistory.objects.filter(content_type=ct, object_id=entries[3].pk).delete()
+        fd, output = tempfile.mkstemp()
+        os.close(fd)
+        state = output + '.state'
+        from django.db.models import signals
+        loaded = list()
+        def count_loaded(instance, **kwargs):
+            loaded.append(instance)
+        signals.post_init.connect(count_loaded, sender=Test3Model)
+        try:
+            call_command('audit_fullhistory', output=output, state=state, content_types=['fullhistory.test3model'],
+                         processes=1, range_size=2, batch_size=2, verbosity=0)
+            signals.post_init.disconnect(count_loaded, sender=Test3Model)
+            self.assertEqual([], loaded)
+            mismatches = [json.loads(line) for line in open(output)]
+            self.assertEqual([(unicode(entries[1].pk), 'value'), (unicode(entries[2].pk), 'chain'), 
+                              (unicode(entries[3].pk), 'missing')],
+                             sorted([(row['object_id'], row['error']) for row in mismatches]))
+            value = [row for row in mismatches if row['error'] == 'value'][0]
+            self.assertEqual(('field2', 7, 1), (value['attr'], value['recorded'], value['live']))
+            self.assertTrue(json.load(open(state)))
+            #every range is done, resuming adds nothing
+            call_command('audit_fullhistory', output=output, state=state, content_types=['fullhistory.test3model'],
+                         processes=1, range_size=2, batch_size=1, verbosity=0)
+            self.assertEqual(3, len(open(output).readlines()))
+        finally:
+            signals.post_init.disconnect(count_loaded, sender=Test3Model)
+            os.remove(output)
+            os.remove(state)
+
+    def test_diff(self):
+        fullhistory.end_session()
+        t3 = Test3Model(field1="a", field2=0)
+        t3.save()
+        for field1, field2 in (("b", 1), ("a", 2), ("a", 3)):
+            t3.field1 = field1
+            t3.field2 = field2
+            t3.save()
+        def expected(from_version, to_version):
+            before = FullHistory.objects.get_version(t3, version=from_version)
+            after = FullHistory.objects.get_version(t3, version=to_version)
+            return dict([(key, (before[key], after[key])) for key in after if before[key] != after[key]])
+        self.assertEqual({'field2': (0, 2)}, FullHistory.objects.diff(t3, from_version=0, to_version=2))
+        self.assertEqual({'field1': ('a', 'b'), 'field2': (0, 1)}, 
+                         FullHistory.objects.diff(model=Test3Model, pk=t3.pk, from_version=0, to_version=1))
+        self.assertEqual({'field2': (3, 1), 'field1': ('a', 'b')}, 
+                         FullHistory.objects.diff(t3, from_version=3, to_version=1))
+        for from_version in range(4):
+            for to_version in range(from_version, 4):
+                self.assertEqual(expected(from_version, to_version), 
+                                 FullHistory.objects.diff(t3, from_version=from_version, to_version=to_version))
+        created = FullHistory.objects.diff(t3)
+        self.assertEqual(('a', 3), (created['field1'][1], created['field2'][1]))
+        self.assertEqual((None, None), (created['field1'][0], created['field2'][0]))
+        #compacted histories fall back to comparing the versions
+        ct = ContentType.objects.get_for_model(t3)
+        FullHistory.objects.checkpoint_revisions(ct, unicode(t3.pk), [2])
+        FullHistory.objects.filter(content_type=ct, object_id=t3.pk, revision=1).delete()
+        self.assertEqual({'field2': (0, 3)}, FullHistory.objects.diff(t3, from_version=0, to_version=3))
+
+        if not django1_1:
+            return
+        base = '/admin/%s/%s/%s/history/' % (Test3Model._meta.app_label, Test3Model._meta.module_name, t3.pk)
+        response = self.client.get('%scompare/?from=0&to=3' % base)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([('field2', (0, 3))], response.context[0]['changes'])
+        self.assertEqual(404, self.client.get('%scompare/?from=0' % base).status_code)
+
+    def test_write_path_queries(self):
+        from django.db import connection
+        from django.contrib.sites.models import Site
+        fullhistory.end_session()
+        Test3Model.objects.create(field1="warm up", field2=0)
+        def statements(func, words=3):
+            settings.DEBUG = True
+            connection.queries = []
+            try:
+                func()
+                return [' '.join(query['sql'].split()[:words]) for query in connection.queries]
+            finally:
+                settings.DEBUG = False
+        t3 = Test3Model(field1="queries", field2=0)
+        table = Test3Model._meta.db_table
+        m2m = 'SELECT "fullhistory_test1model"."id" FROM'
+        self.assertEqual(['INSERT INTO "%s"' % table, 
+                          m2m,
+                          'INSERT INTO "fullhistory_historyhead"', 
+                          'INSERT INTO "fullhistory_fullhistory"'], 
+                         statements(t3.save))
+        t3.field2 = 1
+        self.assertEqual(['SELECT (1) AS', 
+                          'UPDATE "%s" SET' % table, 
+                          m2m,
+                          'UPDATE "fullhistory_historyhead" SET',
+                          'SELECT "fullhistory_historyhead"."id", "fullhistory_historyhead"."content_type_id",',
+                          'INSERT INTO "fullhistory_fullhistory"'], 
+                         statements(t3.save))
+        #the site is read from SITE_ID when the history is made
+        Site.objects.create(pk=2, domain='other.example.com', name='other')
+        settings.SITE_ID = 2
+        try:
+            t3.field2 = 2
+            self.assertFalse([sql for sql in statements(t3.save, None) if 'django_site' in sql])
+            self.assertEqual(2, FullHistory.objects.actions_for_object(t3).reverse()[0].site_id)
+        finally:
+            settings.SITE_ID = 1
+
+    def test_stats(self):
+        import stats
+        from django.http import HttpResponse
+        from signals import stats_collected
+        fullhistory.end_session()
+        handler = fullhistory.REGISTERED_MODELS[Test3Model]
+        self.assertFalse('create_history' in handler.__dict__)
+        stats.STATS.reset()
+        stats.install(handler)
+        collected = list()
+        def receiver(sender, request, summary, **kwargs):
+            collected.append(summary)
+        stats_collected.connect(receiver)
+        settings.FULLHISTORY_STATS = True
+        settings.FULLHISTORY_STATS_HEADER = True
+        try:
+            class FakeRequest(object):
+                path = '/stats/'
+                user = User.objects.get(username='test')
+            request = FakeRequest()
+            middleware = fullhistory.FullHistoryMiddleware()
+            middleware.process_request(request)
+            t3 = Test3Model(field1="stats", field2=0)
+            t3.save()
+            t3.field2 = 1
+            t3.save()
+            t3.test1_m2m.add(Test1Model.objects.create(field1="stats"))
+            fullhistory.adjust_history(t3)
+            response = middleware.process_response(request, HttpResponse())
+            self.assertTrue(response['X-FullHistory'].startswith('histories=2 bytes='))
+            self.assertEqual(1, len(collected))
+            self.assertEqual(2, collected[0]['rows'])
+
+            snapshot = stats.STATS.snapshot()['fullhistory.test3model']
+            self.assertEqual(2, snapshot['rows'])
+            self.assertEqual(collected[0]['bytes'], snapshot['bytes'])
+            #the adjusted history is counted once, with the size it was written with
+            self.assertEqual(sum([len(history._data) for history in FullHistory.objects.actions_for_object(t3)]),
+                             snapshot['bytes'])
+            self.assertEqual(2, snapshot['create_history']['calls'])
+            self.assertEqual(4, snapshot['get_all_data']['calls'])
+            self.assertEqual(2, snapshot['get_difference']['calls'])
+            self.assertEqual(1, snapshot['adjust_history']['calls'])
+            create = snapshot['create_history']
+            self.assertTrue(0 <= create['p50'] <= create['p99'] <= create['time'])
+        finally:
+            del settings.FULLHISTORY_STATS
+            del settings.FULLHISTORY_STATS_HEADER
+            stats_collected.disconnect(receiver)
+            stats.uninstall(handler)
+            stats.STATS.reset()
+        self.assertFalse('create_history' in handler.__dict__)
+
+    def test_field_policies(self):
+        from serializers import hash_value, is_hashed
+        fullhistory.end_session()
+        handler = fullhistory.REGISTERED_MODELS[Test3Model]
+        fullhistory.REGISTERED_MODELS[Test3Model] = fullhistory.FullHistoryHandler(
+            Test3Model, exclude=['field3'], large_field_policy={'field1': 'hash', 'test1_m2m': 'skip'})
+        try:
+            t3 = Test3Model(field1=u"large\xe9", field2=0)
+            t3.save()
+            t3.field1 = "larger"
+            t3.field2 = 1
+            t3.save()
+            histories = FullHistory.objects.actions_for_object(t3)
+            data = histories.get(revision=0).data
+            self.assertEqual([hash_value(u"large\xe9")], data['field1'])
+            self.assertTrue(data['field1'][0].endswith(':6'))
+            self.assertFalse('field3' in data)
+            self.assertFalse('test1_m2m' in data)
+            self.assertEqual([hash_value(u"large\xe9"), hash_value("larger")],
+                             histories.get(revision=1).data['field1'])
+            obj = FullHistory.objects.audit(t3)
+            self.assertTrue(is_hashed(obj['field1']))
+            t3.field2 = 2
+            t3.save()
+            rolled = FullHistory.objects.rollback(t3, version=1).object
+            self.assertEqual((1, "larger"), (rolled.field2, rolled.field1))
+            Test3Model.objects.filter(pk=t3.pk).update(field1="changed")
+            mismatches = FullHistory.objects.compare(obj, Test3Model.objects.get(pk=t3.pk))
+            self.assertEqual([('field1', hash_value("larger"), hash_value("changed"))], mismatches)
+        finally:
+            fullhistory.REGISTERED_MODELS[Test3Model] = handler
+        #histories recorded in full still audit against a hashing policy and the other way around
+        mismatches = FullHistory.objects.compare({'field1': hash_value('changed')}, Test3Model.objects.get(pk=t3.pk))
+        self.assertFalse('field1' in [key for key, recorded, value in mismatches])
+        self.assertTrue('field2' in [key for key, recorded, value in mismatches])
+        self.assertFalse(is_hashed('sha1:a:1'))
+
+        #switching the policy back and forth keeps the chain auditable
+        t3 = Test3Model(field1="orig", field2=0)
+        t3.save()
+        fullhistory.REGISTERED_MODELS[Test3Model] = fullhistory.FullHistoryHandler(
+            Test3Model, large_field_policy={'field1': 'hash'})
+        try:
+            t3 = Test3Model.objects.get(pk=t3.pk)
+            t3.field1 = "hashed"
+            t3.save()
+            self.assertEqual([hash_value("orig"), hash_value("hashed")], 
+                             FullHistory.objects.actions_for_object(t3).get(revision=1).data['field1'])
+            FullHistory.objects.audit(t3)
+        finally:
+            fullhistory.REGISTERED_MODELS[Test3Model] = handler
+        t3 = Test3Model.objects.get(pk=t3.pk)
+        t3.field1 = "full"
+        t3.save()
+        self.assertEqual(["hashed", "full"], 
+                         FullHistory.objects.actions_for_object(t3).get(revision=2).data['field1'])
+        self.assertEqual("full", FullHistory.objects.audit(t3)['field1'])
+        self.assertRaises(ValueError, fullhistory.FullHistoryHandler, Test3Model,
+                          large_field_policy='compress')
+        #building a handler leaves the registered one alone
+        self.assertTrue(handler.extractor is fullhistory.get_extractor(Test3Model))
+        self.assertTrue('field1' in [name for name, attname, convert in handler.extractor.fields])
+
+        #the field options are not passed on to parents
+        registered = dict([(model, fullhistory.REGISTERED_MODELS.pop(model)) 
+                           for model in (Test4Model, Test2Model)])
+        try:
+            fullhistory.register_model(Test4Model, fields=['field2'])
+            child = fullhistory.REGISTERED_MODELS[Test4Model].extractor
+            parent = fullhistory.REGISTERED_MODELS[Test2Model].extractor
+            self.assertEqual(['test2model_ptr', 'field2'], [name for name, attname, convert in child.fields])
+            self.assertTrue('field1' in [name for name, attname, convert in parent.fields])
+        finally:
+            fullhistory.REGISTERED_MODELS.update(registered)
@@ -4,17 +4,43 @@ from django.utils.encoding import force_unicode
 from django.utils.text import capfirst
 from django.template import RequestContext
 from django.utils.translation import ugettext as _
+from django.conf import settings
 
-from models import FullHistory
+from models import FullHistory, load_users
 
 def history_log(request, object_id, model, template, extra_context=None):
     opts = model._meta
     app_label = opts.app_label
     obj = get_object_or_404(model, pk=object_id)
-    action_list = FullHistory.objects.actions_for_object(obj).select_related()
+    page_size = getattr(settings, 'FULLHISTORY_ADMIN_PAGE_SIZE', 50)
+    #request is nullable so it has to be named to be joined
+    actions = FullHistory.objects.actions_for_object(obj).select_related('request')
+    before = request.GET.get('before')
+    try:
+        after = int(request.GET.get('after', -1))
+        if before not in (None, 'end'):
+            actions = actions.filter(revision__lt=int(before))
+    except ValueError:
+        raise Http404()
+    if before is not None:
+        #walking backwards, read the page below before and put it back in order
+        action_list = list(actions.reverse()[:page_size+1])
+        has_previous = len(action_list) > page_size
+        action_list = action_list[:page_size]
+        action_list.reverse()
+        has_next = before != 'end'
+    else:
+        action_list = list(actions.filter(revision__gt=after)[:page_size+1])
+        has_next = len(action_list) > page_size
+        action_list = action_list[:page_size]
+        has_previous = after >= 0
+    action_list = load_users(action_list)
     context = {
         'title': _(u'Change history: %s') % force_unicode(obj),
         'action_list': action_list,
+        'has_next': has_next and bool(action_list),
+        'has_previous': has_previous and bool(action_list),
+        'page_size': page_size,
         'module_name': capfirst(force_unicode(opts.verbose_name_plural)),
         'object': obj,
         'app_label': app_label,
@@ -62,3 +88,29 @@ def history_version(request, object_id, version, model, template, extra_context=
     context.update(extra_context or {})
     return render_to_response(template, context, context_instance=RequestContext(request))
 
+
+def history_compare(request, object_id, model, template, extra_context=None):
+    try:
+        from_version = int(request.GET['from'])
+        to_version = int(request.GET['to'])
+    except (KeyError, ValueError):
+        raise Http404()
+    obj = get_object_or_404(model, pk=object_id)
+    try:
+        changes = FullHistory.objects.diff(model=model, pk=object_id, 
+                                           from_version=from_version, to_version=to_version)
+    except FullHistory.DoesNotExist:
+        raise Http404()
+    opts = model._meta
+    app_label = opts.app_label
+    context = {
+        'title': _(u'Changes from version %s to %s: %s') % (from_version, to_version, force_unicode(obj)),
+        'module_name': capfirst(force_unicode(opts.verbose_name_plural)),
+        'object': obj,
+        'app_label': app_label,
+        'from_version': from_version,
+        'to_version': to_version,
+        'changes': sorted(changes.items()),
+    }
+    context.update(extra_context or {})
+    return render_to_response(template, context, context_instance=RequestContext(request))
@@ -0,0 +1,151 @@
+import atexit
+import logging
+import threading
+import Queue
+
+logger = logging.getLogger('fullhistory')
+
+BLOCK = 'block'
+DROP = 'drop'
+SYNC = 'sync'
+
+class HistoryWriter(object):
+    '''
+    Writes histories from a background thread in batches
+    ``write`` is called with a list of (history, instance) pairs
+    ``overflow`` decides what happens when the queue is full:
+    block until there is room, drop the history and count it or write it synchronously
+    '''
+    def __init__(self, write, maxsize=1000, batch_size=100, overflow=BLOCK):
+        assert overflow in (BLOCK, DROP, SYNC), 'Unknown overflow policy %s' % overflow
+        self.write = write
+        self.queue = Queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        #held while a batch is taken from the queue and written, keeps synchronous writes in order
+        self.write_lock = threading.Lock()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='fullhistory-writer')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def put(self, pending):
+        '''
+        Queues (history, instance) pairs for writing
+        '''
+        for item in pending:
+            if self.overflow == BLOCK:
+                self.queue.put(item)
+                continue
+            try:
+                self.queue.put_nowait(item)
+            except Queue.Full:
+                if self.overflow == DROP:
+                    self.lock.acquire()
+                    self.dropped += 1
+                    self.lock.release()
+                else:
+                    self.write_through(item)
+
+    def write_through(self, item):
+        '''
+        Writes the queued histories and then item in the calling thread
+        Revisions are allocated when a history is written, so the queue goes first
+        '''
+        self.write_lock.acquire()
+        try:
+            batch = list()
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in batch
+            try:
+                self.write([queued for queued in batch if queued is not None] + [item])
+            finally:
+                for i in range(len(batch)):
+                    self.queue.task_done()
+                if stop:
+                    #the worker still has to see the shutdown
+                    self.queue.put(None)
+        finally:
+            self.write_lock.release()
+
+    def run(self):
+        while True:
+            #the queue is not empty while write_through waits for the lock, so get returns
+            self.write_lock.acquire()
+            try:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                stop = None in batch
+                batch = [item for item in batch if item is not None]
+                try:
+                    if batch:
+                        self.write(batch)
+                except Exception:
+                    logger.exception('Failed to write %s histories' % len(batch))
+                for i in range(len(batch) + int(stop)):
+                    self.queue.task_done()
+            finally:
+                self.write_lock.release()
+            if stop:
+                return
+
+    def flush(self):
+        '''
+        Blocks until every queued history has been written
+        '''
+        if self.thread is not None:
+            self.queue.join()
+
+    def shutdown(self):
+        '''
+        Writes the remaining histories and stops the worker thread
+        '''
+        self.lock.acquire()
+        thread, self.thread = self.thread, None
+        self.lock.release()
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+WRITER = None
+WRITER_LOCK = threading.Lock()
+
+def get_writer(write):
+    '''
+    Returns the process wide background writer, starting it on first use
+    '''
+    global WRITER
+    if WRITER is not None:
+        return WRITER
+    WRITER_LOCK.acquire()
+    try:
+        if WRITER is not None:
+            return WRITER
+        from django.conf import settings
+        writer = HistoryWriter(write,
+                               maxsize=getattr(settings, 'FULLHISTORY_WRITER_QUEUE_SIZE', 1000),
+                               batch_size=getattr(settings, 'FULLHISTORY_WRITER_BATCH_SIZE', 100),
+                               overflow=getattr(settings, 'FULLHISTORY_WRITER_OVERFLOW', BLOCK))
+        writer.start()
+        atexit.register(writer.shutdown)
+        WRITER = writer
+        return WRITER
+    finally:
+        WRITER_LOCK.release()
@@ -0,0 +1,124 @@
+'''
+Micro benchmarks for fullhistory, run them from the testproject directory:
+
+    python benchmarks/extractor.py
+    python benchmarks/run.py --output=results.json
+
+Every benchmark prints its results as JSON so runs can be compared across commits
+'''
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+TESTPROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup():
+    '''
+    Configures django and creates a fresh test database
+    '''
+    if TESTPROJECT not in sys.path:
+        sys.path.insert(0, TESTPROJECT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+    from django.test.utils import setup_test_environment
+    from django.db import connection
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+def make_ticket(summary=u'benchmark'):
+    from ticketmanager.models import Ticket, TriageState
+    state, created = TriageState.objects.get_or_create(title=u'New')
+    ticket = Ticket(summary=summary,
+                    description=u'A fairly long description\n' * 20,
+                    keywords=u'benchmark, fullhistory',
+                    cc=u'someone@example.com',
+                    triage_state=state)
+    ticket.save()
+    return ticket
+
+def timed(func, number):
+    '''
+    Returns the seconds per call of func averaged over number calls
+    '''
+    start = time.time()
+    for i in xrange(number):
+        func()
+    return (time.time() - start) / number
+
+def cpu_time():
+    '''
+    Returns the user and system CPU seconds used by this process
+    '''
+    usage = os.times()
+    return usage[0] + usage[1]
+
+def count_queries(func):
+    '''
+    Returns the number of queries func runs
+    '''
+    from django.conf import settings
+    from django.db import connection
+    debug, settings.DEBUG = settings.DEBUG, True
+    connection.queries = []
+    try:
+        func()
+        return len(connection.queries)
+    finally:
+        settings.DEBUG = debug
+        connection.queries = []
+
+@contextmanager
+def untracked(model):
+    '''
+    Disconnects the history signals of a registered model inside the with block
+    '''
+    from django.db.models import signals
+    from fullhistory import fullhistory
+    receivers = ((signals.post_init, fullhistory.init_history_signal),
+                 (signals.post_save, fullhistory.save_history_signal),
+                 (signals.post_delete, fullhistory.delete_history_signal))
+    for signal, receiver in receivers:
+        signal.disconnect(receiver, sender=model)
+    try:
+        yield
+    finally:
+        for signal, receiver in receivers:
+            signal.connect(receiver, sender=model)
+
+@contextmanager
+def override_settings(**options):
+    from django.conf import settings
+    missing = object()
+    previous = dict([(name, getattr(settings, name, missing)) for name in options])
+    for name, value in options.items():
+        setattr(settings, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is missing:
+                delattr(settings, name)
+            else:
+                setattr(settings, name, value)
+
+def report(results, stream=None):
+    '''
+    Writes results as JSON together with what they were measured on
+    '''
+    import json
+    import platform
+    import subprocess
+    import django
+    try:
+        commit = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=TESTPROJECT,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        commit = None
+    output = {'commit': commit or None,
+              'python': platform.python_version(),
+              'django': django.get_version(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+    stream = stream or sys.stdout
+    json.dump(output, stream, indent=2, sort_keys=True)
+    stream.write('\n')
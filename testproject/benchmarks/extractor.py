@@ -0,0 +1,29 @@
+'''
+Compares the per model FieldExtractor with the generic Serializer on Ticket
+'''
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import setup, make_ticket, timed, report
+
+def serialize(ticket):
+    from fullhistory.serializers import Serializer
+    serial = Serializer().serialize([ticket])[0]
+    serial['fields'][ticket._meta.pk.name] = serial['pk']
+    return serial['fields']
+
+def run(number=2000):
+    from fullhistory.serializers import get_extractor
+    ticket = make_ticket()
+    extractor = get_extractor(type(ticket))
+    assert serialize(ticket) == extractor.extract(ticket)
+    serializer_time = timed(lambda: serialize(ticket), number)
+    extractor_time = timed(lambda: extractor.extract(ticket), number)
+    return {'serializer': serializer_time,
+            'extractor': extractor_time,
+            'speedup': serializer_time / extractor_time}
+
+if __name__ == '__main__':
+    setup()
+    report({'extractor': run()})
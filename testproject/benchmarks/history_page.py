@@ -0,0 +1,39 @@
+'''
+Measures render time and query counts of the admin history pages of a Ticket
+'''
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import setup, timed, count_queries, report
+from benchmarks.reconstruction import build_history
+
+LENGTHS = (10, 1000)
+
+def run(lengths=LENGTHS, number=20):
+    from django.contrib.auth.models import User
+    from django.test.client import Client
+    user = User(username='benchmark', is_staff=True, is_superuser=True)
+    user.set_password('benchmark')
+    user.save()
+    client = Client()
+    client.login(username='benchmark', password='benchmark')
+    results = dict()
+    for length in lengths:
+        ticket = build_history(length)
+        base = '/admin/ticketmanager/ticket/%s/history/' % ticket.pk
+        pages = {'log': base,
+                 'last_page': base + '?before=end',
+                 'version': base + 'version/%s/' % (length - 1),
+                 'compare': base + 'compare/?from=0&to=%s' % (length - 1)}
+        results[str(length)] = dict()
+        for name, url in pages.items():
+            get = lambda: client.get(url)
+            assert get().status_code == 200, url
+            results[str(length)][name] = {'seconds': timed(get, number),
+                                          'queries': count_queries(get)}
+    return results
+
+if __name__ == '__main__':
+    setup()
+    report({'history_page': run()})
@@ -0,0 +1,59 @@
+'''
+Measures the CPU time and memory of loading tracked Ticket instances
+'''
+from __future__ import with_statement
+import gc
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import setup, make_ticket, cpu_time, untracked, report
+
+def snapshot_bytes(tickets):
+    '''
+    Shallow size of the snapshots the tickets hold for fullhistory
+    '''
+    size = 0
+    for ticket in tickets:
+        for name in ('_fullhistory', '_fullhistory_raw'):
+            snapshot = ticket.__dict__.get(name)
+            if snapshot is not None:
+                size += sys.getsizeof(snapshot) + sum([sys.getsizeof(value) for value in snapshot.values()])
+    return size
+
+def load(count):
+    from ticketmanager.models import Ticket
+    gc.collect()
+    objects = len(gc.get_objects())
+    start, cpu = time.time(), cpu_time()
+    tickets = list(Ticket.objects.all()[:count])
+    result = {'seconds': time.time() - start,
+              'cpu_seconds': cpu_time() - cpu,
+              'gc_objects': len(gc.get_objects()) - objects,
+              'snapshot_bytes': snapshot_bytes(tickets)}
+    del tickets
+    return result
+
+def run(count=1000):
+    from fullhistory import fullhistory
+    from ticketmanager.models import Ticket
+    with untracked(Ticket):
+        for i in xrange(count - Ticket.objects.count()):
+            make_ticket()
+        results = {'untracked': load(count)}
+    handler = fullhistory.REGISTERED_MODELS[Ticket]
+    lazy_initial = handler.lazy_initial
+    try:
+        handler.lazy_initial = True
+        results['lazy'] = load(count)
+        handler.lazy_initial = False
+        results['eager'] = load(count)
+    finally:
+        handler.lazy_initial = lazy_initial
+    results['instances'] = count
+    return results
+
+if __name__ == '__main__':
+    setup()
+    report({'loading': run()})
@@ -0,0 +1,41 @@
+'''
+Measures get_version latency as the history of a Ticket grows
+'''
+from __future__ import with_statement
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import setup, make_ticket, timed, count_queries, override_settings, report
+
+LENGTHS = (10, 100, 1000, 10000)
+
+def build_history(length):
+    ticket = make_ticket()
+    for i in xrange(length - 1):
+        ticket.keywords = u'revision %s' % i
+        ticket.save()
+    return ticket
+
+def latency(length):
+    from fullhistory.models import FullHistory
+    ticket = build_history(length)
+    number = max(3, 1000 // length)
+    latest = lambda: FullHistory.objects.get_version(ticket)
+    middle = lambda: FullHistory.objects.get_version(ticket, version=length // 2)
+    return {'latest': timed(latest, number),
+            'middle': timed(middle, number),
+            'latest_queries': count_queries(latest),
+            'middle_queries': count_queries(middle)}
+
+def run(lengths=LENGTHS):
+    results = {'checkpoints': dict(), 'no_checkpoints': dict()}
+    for length in lengths:
+        results['checkpoints'][str(length)] = latency(length)
+        with override_settings(FULLHISTORY_CHECKPOINT_REVISIONS=None, FULLHISTORY_CHECKPOINT_BYTES=None):
+            results['no_checkpoints'][str(length)] = latency(length)
+    return results
+
+if __name__ == '__main__':
+    setup()
+    report({'reconstruction': run()})
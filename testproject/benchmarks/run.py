@@ -0,0 +1,41 @@
+'''
+Runs every benchmark and writes one JSON document
+
+    python benchmarks/run.py --output=results.json
+    python benchmarks/run.py --quick
+'''
+import os
+import sys
+from optparse import OptionParser
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import setup, report
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--output', dest='output', default=None,
+                      help='File to write the results to, defaults to stdout')
+    parser.add_option('--quick', action='store_true', dest='quick', default=False,
+                      help='Smaller runs to check the benchmarks work')
+    options, args = parser.parse_args()
+    setup()
+    from benchmarks import extractor, writes, reconstruction, loading, history_page
+    if options.quick:
+        results = {'extractor': extractor.run(100),
+                   'writes': writes.run(20),
+                   'reconstruction': reconstruction.run((10, 100)),
+                   'loading': loading.run(100),
+                   'history_page': history_page.run((10, 100), 2)}
+    else:
+        results = {'extractor': extractor.run(),
+                   'writes': writes.run(),
+                   'reconstruction': reconstruction.run(),
+                   'loading': loading.run(),
+                   'history_page': history_page.run()}
+    stream = None
+    if options.output:
+        stream = open(options.output, 'w')
+    report(results, stream)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+'''
+Measures Ticket saves per second with and without history tracking
+'''
+from __future__ import with_statement
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import setup, make_ticket, timed, count_queries, untracked, report
+
+def saves(number):
+    ticket = make_ticket()
+    def update():
+        ticket.keywords = ticket.keywords == u'a' and u'b' or u'a'
+        ticket.save()
+    return {'creates_per_second': 1 / timed(make_ticket, number),
+            'updates_per_second': 1 / timed(update, number),
+            'create_queries': count_queries(make_ticket),
+            'update_queries': count_queries(update)}
+
+def buffered_updates(number):
+    from fullhistory import fullhistory
+    ticket = make_ticket()
+    start = time.time()
+    with fullhistory.buffered():
+        for i in xrange(number):
+            ticket.keywords = u'buffered %s' % i
+            ticket.save()
+    return {'updates_per_second': number / (time.time() - start)}
+
+def run(number=500):
+    from ticketmanager.models import Ticket
+    results = {'tracked': saves(number),
+               'buffered': buffered_updates(number)}
+    with untracked(Ticket):
+        results['untracked'] = saves(number)
+    return results
+
+if __name__ == '__main__':
+    setup()
+    report({'writes': run()})